@@ -1,26 +1,104 @@
 """FastAPI wrapper for Cloud Run deployment."""
 
 import asyncio
+import os
 from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import FileResponse
+from google.cloud import bigquery
 from loguru import logger
+from pydantic import BaseModel
 
-from main import main as run_pipeline
+from config import load_config, validate_config
+from jobs import Job, JobManager
+from main import main_async as run_pipeline
+from media import open_media_store
+from main import refresh_engagement_main_async as run_engagement_refresh
+from main import reingest_main_async as run_reingest
+from profiling import (
+    PROFILE_MODES,
+    RunProfiler,
+    list_profiles,
+    load_profile_summary,
+    profile_artifact_path,
+    profiling_active,
+)
+from telegram_bq_ingest import NormalizationPool, connect_telegram_client
+
+JOB_KINDS = {
+    "ingest": run_pipeline,
+    "reingest": run_reingest,
+    "engagement": run_engagement_refresh,
+}
+
+
+class JobRequest(BaseModel):
+    """Body of POST /jobs. Omitted groups mean all relevant groups.
 
+    ``reingest`` jobs need both dates; ``days`` only applies to ``engagement``.
+    """
 
-# Track if a job is currently running
-job_running = False
-last_run_result: dict | None = None
+    kind: str = "ingest"
+    groups: list[str] | None = None
+    from_date: str | None = None
+    to_date: str | None = None
+    days: int | None = None
+    profile: str | None = None
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """Application lifespan handler."""
+    """Application lifespan handler.
+
+    Owns one connected Telegram client, one BigQuery client and the media store
+    for the whole process, so each job skips the connect/auth handshakes, the
+    normalization process pool shared by all jobs, and the job queue.
+    """
     logger.info("Telegram Scraper service starting up...")
+    app.state.telegram_client = None
+    app.state.bq_client = None
+    app.state.media_store = None
+    app.state.normalization_pool = None
+
+    config = load_config()
+    app.state.jobs = JobManager(int(config["JOBS_MAX_CONCURRENT"]))
+    normalize_workers = int(config["NORMALIZE_WORKERS"])
+    if normalize_workers > 0:
+        app.state.normalization_pool = NormalizationPool(
+            normalize_workers, int(config["NORMALIZE_BATCH_SIZE"])
+        )
+        logger.info(f"Normalizing messages with {app.state.normalization_pool}")
+    try:
+        validate_config(config)
+        if config["SINK"] == "bigquery":
+            app.state.bq_client = bigquery.Client(project=config["BQ_PROJECT_ID"])
+        if config["MEDIA_ENABLED"].lower() == "true":
+            app.state.media_store = await asyncio.to_thread(
+                open_media_store, config["MEDIA_STORE"]
+            )
+        app.state.telegram_client = await connect_telegram_client(
+            {
+                "TELEGRAM_API_ID": config["TELEGRAM_API_ID"],
+                "TELEGRAM_API_HASH": config["TELEGRAM_API_HASH"],
+            }
+        )
+        logger.info("Telegram and BigQuery clients connected")
+    except Exception as e:
+        logger.warning(f"Could not warm clients, each run will connect on its own: {e}")
+
     yield
+
     logger.info("Telegram Scraper service shutting down...")
+    for job in app.state.jobs.active():
+        app.state.jobs.cancel(job.id)
+    if app.state.telegram_client is not None:
+        await app.state.telegram_client.disconnect()
+    if app.state.bq_client is not None:
+        app.state.bq_client.close()
+    if app.state.normalization_pool is not None:
+        await app.state.normalization_pool.close()
 
 
 app = FastAPI(
@@ -31,34 +109,81 @@ app = FastAPI(
 )
 
 
-def run_scraping_job():
-    """Run the scraping job synchronously."""
-    global job_running, last_run_result
-
-    job_running = True
-    start_time = datetime.now(timezone.utc)
+async def run_scraping_job(job: Job, pipeline=run_pipeline, **kwargs):
+    """Run a pipeline job on the server's event loop with the warm clients.
 
+    With ``job.profile`` set the job runs under a RunProfiler and the profile id is
+    reported on the job, to be fetched from /profiles.
+    """
+    logger.info(f"Starting {job.kind} job {job.id}...")
+    if not job.profile:
+        return await pipeline(
+            telegram_client=app.state.telegram_client,
+            bq_client=app.state.bq_client,
+            **kwargs,
+        )
+    profiler = RunProfiler(job.profile, load_config()["PROFILES_DIR"], run_id=job.id)
     try:
-        logger.info("Starting Telegram scraping job...")
-        run_pipeline()
+        async with profiler:
+            return await pipeline(
+                telegram_client=app.state.telegram_client,
+                bq_client=app.state.bq_client,
+                **kwargs,
+            )
+    finally:
+        job.profile_id = profiler.profile_id
 
-        last_run_result = {
-            "status": "success",
-            "started_at": start_time.isoformat(),
-            "completed_at": datetime.now(timezone.utc).isoformat(),
-        }
-        logger.info("Telegram scraping job completed successfully")
 
-    except Exception as e:
-        logger.error(f"Telegram scraping job failed: {e}")
-        last_run_result = {
-            "status": "failed",
-            "started_at": start_time.isoformat(),
-            "completed_at": datetime.now(timezone.utc).isoformat(),
-            "error": str(e),
+def submit_job(request: JobRequest) -> Job:
+    """Validate a job request and queue it."""
+    if request.kind not in JOB_KINDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown job kind: {request.kind} (expected one of {', '.join(JOB_KINDS)})"
+        )
+    if request.profile is not None and request.profile not in PROFILE_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown profile mode: {request.profile} (expected one of {', '.join(PROFILE_MODES)})"
+        )
+    # Profilers hook the shared event loop thread, so two at once corrupt each other
+    if request.profile is not None and (
+        profiling_active() or any(job.profile for job in app.state.jobs.active())
+    ):
+        raise HTTPException(
+            status_code=409, detail="Another profiled job is queued or running"
+        )
+    for date in (request.from_date, request.to_date):
+        if date is not None:
+            try:
+                datetime.fromisoformat(date)
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Invalid ISO date: {date}")
+
+    if request.kind == "reingest" and not (request.from_date and request.to_date):
+        raise HTTPException(
+            status_code=400, detail="reingest jobs need both from_date and to_date"
+        )
+
+    job = Job(request.kind, request.groups, request.from_date, request.to_date, request.profile)
+    if request.kind in ("ingest", "reingest"):
+        kwargs = {
+            "from_date": request.from_date,
+            "to_date": request.to_date,
+            "normalization_pool": app.state.normalization_pool,
         }
-    finally:
-        job_running = False
+        if request.kind == "ingest":
+            kwargs["media_store"] = app.state.media_store
+    else:
+        kwargs = {"days": request.days}
+    app.state.jobs.submit(
+        job,
+        lambda job: run_scraping_job(
+            job, JOB_KINDS[job.kind], group_ids=request.groups, **kwargs
+        ),
+    )
+    logger.info(f"Queued {job.kind} job {job.id} for {', '.join(job.groups or ['all groups'])}")
+    return job
 
 
 @app.get("/health")
@@ -74,30 +199,121 @@ async def health_check():
 @app.get("/status")
 async def get_status():
     """Get the current status of the scraper."""
+    jobs = app.state.jobs.jobs()
+    finished = [job for job in jobs if not job.active]
     return {
-        "job_running": job_running,
-        "last_run": last_run_result,
+        "job_running": any(job.status == "running" for job in jobs),
+        "active_jobs": [job.id for job in jobs if job.active],
+        "last_run": finished[0].to_dict() if finished else None,
         "timestamp": datetime.now(timezone.utc).isoformat(),
     }
 
 
 @app.post("/run")
-async def trigger_run(background_tasks: BackgroundTasks):
-    """Trigger a scraping run. Called by Cloud Scheduler."""
-    global job_running
+async def trigger_run(profile: str | None = None):
+    """Trigger a full scraping run. Called by Cloud Scheduler.
 
-    if job_running:
+    Pass ``?profile=cprofile`` or ``?profile=sampling`` to profile the run.
+    A full run is refused while another one is queued or running; targeted
+    runs go through POST /jobs.
+    """
+    if any(job.groups is None for job in app.state.jobs.active("ingest")):
         raise HTTPException(
             status_code=409,
             detail="A scraping job is already running"
         )
 
     logger.info("Received request to start scraping job")
-    background_tasks.add_task(run_scraping_job)
+    job = submit_job(JobRequest(kind="ingest", profile=profile))
 
     return {
         "status": "started",
         "message": "Scraping job started in background",
+        "job_id": job.id,
+        "profile": profile,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(request: JobRequest):
+    """Queue a job, optionally for a subset of groups and a date window.
+
+    Returns the job right away; poll /jobs/{job_id} for progress.
+    """
+    return submit_job(request).to_dict()
+
+
+@app.get("/jobs")
+async def get_jobs():
+    """List queued, running and recently finished jobs, newest first."""
+    return {"jobs": [job.to_dict() for job in app.state.jobs.jobs()]}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Get a job's status and progress."""
+    job = app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job.to_dict()
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job.
+
+    A running job stops at its next await; groups already written stay written.
+    """
+    job = app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    if not job.active:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} already {job.status}")
+    app.state.jobs.cancel(job_id)
+    return {"status": "cancelling", "job_id": job_id}
+
+
+@app.get("/profiles")
+async def get_profiles():
+    """List saved run profiles, newest first."""
+    return {"profiles": list_profiles(load_config()["PROFILES_DIR"])}
+
+
+@app.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str):
+    """Get a run profile's hotspot summary and await timings."""
+    summary = load_profile_summary(profile_id, load_config()["PROFILES_DIR"])
+    if summary is None:
+        raise HTTPException(status_code=404, detail=f"Profile {profile_id} not found")
+    return summary
+
+
+@app.get("/profiles/{profile_id}/artifact")
+async def get_profile_artifact(profile_id: str):
+    """Download the raw profile (.prof for cProfile, .folded stacks for sampling)."""
+    path = profile_artifact_path(profile_id, load_config()["PROFILES_DIR"])
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"Profile {profile_id} not found")
+    return FileResponse(path, filename=os.path.basename(path))
+
+
+@app.post("/refresh-engagement")
+async def trigger_engagement_refresh():
+    """Trigger an engagement counter refresh. Scheduled separately from /run."""
+    if app.state.jobs.active("engagement"):
+        raise HTTPException(
+            status_code=409,
+            detail="An engagement refresh is already running"
+        )
+
+    logger.info("Received request to refresh engagement counters")
+    job = submit_job(JobRequest(kind="engagement"))
+
+    return {
+        "status": "started",
+        "message": "Engagement refresh started in background",
+        "job_id": job.id,
         "timestamp": datetime.now(timezone.utc).isoformat(),
     }
 
@@ -6,41 +6,85 @@ def get_entities_data_from_bq(
     bq_project: str,
     bq_dataset: str,
     bq_groups_table: str = "groups",
-) -> list[dict[str, str | None]]:
+    client: bigquery.Client | None = None,
+    bq_metadata_table: str | None = None,
+) -> list[dict[str, str | int | None]]:
     """Fetch entities data from BigQuery groups table.
 
+    When ``bq_metadata_table`` is given, the ingestion cursor written by
+    ``update_metadata`` is joined in with the same query, so every group comes
+    back with the point where the next run should resume.
+
     Args:
         bq_project: BigQuery project ID
         bq_dataset: BigQuery dataset name
         bq_groups_table: Name of the groups table (default: 'groups')
+        client: Existing BigQuery client to reuse (default: create a new one)
+        bq_metadata_table: Name of the metadata (cursor) table to join (optional)
 
     Returns:
-        List of entities with id, link, and last_fetch_time
+        List of entities with id, link, last_fetch_time, last_message_id and pts
     """
-    client = bigquery.Client(project=bq_project)
+    if client is None:
+        client = bigquery.Client(project=bq_project)
 
-    # Get groups from the groups table (only relevant ones with links)
-    query = f"""
-    SELECT
-      group_id,
-      group_link,
-      last_fetch_time
-    FROM
-      `{bq_project}.{bq_dataset}.{bq_groups_table}`
-    WHERE
-      (is_relevant = TRUE OR is_relevant IS NULL)
-      AND group_link IS NOT NULL;
-    """
+    groups_table_id = f"{bq_project}.{bq_dataset}.{bq_groups_table}"
+    if bq_metadata_table:
+        # Get relevant groups with their cursor: the metadata table is the source
+        # of truth, groups.last_fetch_time is only a fallback for older setups
+        query = f"""
+        SELECT
+          g.group_id,
+          g.group_link,
+          COALESCE(m.last_fetch_time, g.last_fetch_time) AS last_fetch_time,
+          m.last_message_id,
+          m.pts
+        FROM
+          `{groups_table_id}` AS g
+        LEFT JOIN (
+          SELECT
+            group_id,
+            MAX(last_fetch_time) AS last_fetch_time,
+            MAX(last_message_id) AS last_message_id,
+            MAX(pts) AS pts
+          FROM
+            `{bq_project}.{bq_dataset}.{bq_metadata_table}`
+          GROUP BY
+            group_id
+        ) AS m
+        ON
+          CAST(g.group_id AS STRING) = m.group_id
+        WHERE
+          (g.is_relevant = TRUE OR g.is_relevant IS NULL)
+          AND g.group_link IS NOT NULL;
+        """
+    else:
+        # Get groups from the groups table (only relevant ones with links)
+        query = f"""
+        SELECT
+          group_id,
+          group_link,
+          last_fetch_time,
+          NULL AS last_message_id,
+          NULL AS pts
+        FROM
+          `{groups_table_id}`
+        WHERE
+          (is_relevant = TRUE OR is_relevant IS NULL)
+          AND group_link IS NOT NULL;
+        """
     try:
         query_job = client.query(query)
         results = query_job.result()
-        entities_data: list[dict[str, str | None]] = [
+        entities_data: list[dict[str, str | int | None]] = [
             {
                 "id": str(row["group_id"]),
                 "link": str(row["group_link"]),
                 "last_fetch_time": row["last_fetch_time"].isoformat()
                 if row["last_fetch_time"]
                 else None,
+                "last_message_id": row["last_message_id"],
+                "pts": row["pts"],
             }
             for row in results
         ]
@@ -20,12 +20,67 @@ def load_config() -> dict[str, str | None]:
         'BQ_TABLE': os.getenv('BQ_TABLE', 'telegram_messages'),
         'BQ_METADATA_TABLE': os.getenv('BQ_METADATA_TABLE', 'telegram_last_ingestion'),
         'BQ_GROUPS_TABLE': os.getenv('BQ_GROUPS_TABLE', 'groups'),
+        'BQ_ENGAGEMENT_TABLE': os.getenv('BQ_ENGAGEMENT_TABLE', 'telegram_engagement'),
+        'BQ_MEDIA_TABLE': os.getenv('BQ_MEDIA_TABLE', 'telegram_media'),
+        'BQ_CHANGES_TABLE': os.getenv('BQ_CHANGES_TABLE', 'telegram_message_changes'),
+        'BQ_RUN_STATS_TABLE': os.getenv('BQ_RUN_STATS_TABLE', 'telegram_run_stats'),
+
+        # Storage backend: 'bigquery' or 'sqlite' (offline, see local_store.py)
+        'SINK': os.getenv('SINK', 'bigquery'),
+        'LOCAL_DB_PATH': os.getenv('LOCAL_DB_PATH', 'data/telegram.db'),
+
+        # 'history' polls new messages; 'difference' syncs supergroups/channels from
+        # their update state (pts), which also records edits and deletions
+        'SYNC_MODE': os.getenv('SYNC_MODE', 'history'),
+
+        # Normalization process pool: 0 workers normalizes inline on the event loop
+        'NORMALIZE_WORKERS': os.getenv('NORMALIZE_WORKERS', '0'),
+        'NORMALIZE_BATCH_SIZE': os.getenv('NORMALIZE_BATCH_SIZE', '1000'),
+
+        # Near-duplicate repost detection (fills content_hash / near_dup_of)
+        'NEAR_DUP_ENABLED': os.getenv('NEAR_DUP_ENABLED', 'false'),
+        'NEAR_DUP_INDEX_PATH': os.getenv('NEAR_DUP_INDEX_PATH', 'data/near_dup_index.json'),
+        'NEAR_DUP_THRESHOLD': os.getenv('NEAR_DUP_THRESHOLD', '0.7'),
+        'NEAR_DUP_WINDOW_DAYS': os.getenv('NEAR_DUP_WINDOW_DAYS', '7'),
+
+        # Media downloads (fills media_url): a local directory or gs://bucket/prefix,
+        # files larger than MEDIA_MAX_BYTES or not matching MEDIA_TYPES are skipped
+        'MEDIA_ENABLED': os.getenv('MEDIA_ENABLED', 'false'),
+        'MEDIA_STORE': os.getenv('MEDIA_STORE', 'data/media'),
+        'MEDIA_WORKERS': os.getenv('MEDIA_WORKERS', '4'),
+        'MEDIA_MAX_BYTES': os.getenv('MEDIA_MAX_BYTES', '20000000'),
+        'MEDIA_TYPES': os.getenv('MEDIA_TYPES', 'image/,video/'),
+        # Pending downloads kept in memory; media beyond that are skipped for the run
+        'MEDIA_QUEUE_SIZE': os.getenv('MEDIA_QUEUE_SIZE', '1000'),
+
+        # Directory where profiled runs (--profile, /run?profile=...) are saved
+        'PROFILES_DIR': os.getenv('PROFILES_DIR', 'profiles'),
+
+        # Groups fetched concurrently when re-ingesting a date window (--reingest)
+        'REINGEST_CONCURRENCY': os.getenv('REINGEST_CONCURRENCY', '4'),
+
+        # API job queue: how many jobs may run at once (they never share a group)
+        'JOBS_MAX_CONCURRENT': os.getenv('JOBS_MAX_CONCURRENT', '2'),
+
+        # Engagement refresh: how many days back message counters are re-read
+        'ENGAGEMENT_REFRESH_DAYS': os.getenv('ENGAGEMENT_REFRESH_DAYS', '7'),
     }
 
 
 def validate_config(config: dict[str, str | None]) -> bool:
     """Validate that required configuration values are set."""
-    required_fields = ['TELEGRAM_API_ID', 'TELEGRAM_API_HASH', 'BQ_PROJECT_ID', 'BQ_DATASET']
+    if config.get('SINK', 'bigquery') not in ('bigquery', 'sqlite'):
+        raise ValueError(f"Unknown SINK: {config.get('SINK')} (expected 'bigquery' or 'sqlite')")
+    if config.get('SYNC_MODE', 'history') not in ('history', 'difference'):
+        raise ValueError(
+            f"Unknown SYNC_MODE: {config.get('SYNC_MODE')} (expected 'history' or 'difference')"
+        )
+
+    required_fields = ['TELEGRAM_API_ID', 'TELEGRAM_API_HASH']
+    if config.get('SINK', 'bigquery') == 'bigquery':
+        required_fields += ['BQ_PROJECT_ID', 'BQ_DATASET']
+    else:
+        required_fields += ['LOCAL_DB_PATH']
 
     missing = [field for field in required_fields if not config.get(field)]
 
@@ -0,0 +1,204 @@
+"""In-process job queue for the API server.
+
+Jobs (full sweeps, targeted group refreshes, engagement refreshes) run as tasks
+on the server's event loop. At most ``max_concurrent`` run at a time, the rest
+wait in submission order. Concurrent jobs never work on the same group at once:
+the ingest loop claims each group through ``claim_group`` before fetching it, so a
+one-group refresh submitted during a full sweep runs right away and the sweep only
+waits if it reaches that group while the refresh is still on it.
+
+The ingest loop reports progress to the job it runs in through ``current_job``;
+outside a job (CLI runs) both hooks are no-ops.
+"""
+
+import asyncio
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable
+
+from loguru import logger
+
+_current_job: ContextVar["Job | None"] = ContextVar("current_job", default=None)
+
+
+class Job:
+    """One submitted pipeline run and its progress."""
+
+    def __init__(
+        self,
+        kind: str,
+        groups: list[str] | None = None,
+        from_date: str | None = None,
+        to_date: str | None = None,
+        profile: str | None = None,
+    ):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.groups = groups
+        self.from_date = from_date
+        self.to_date = to_date
+        self.profile = profile
+        self.status = "queued"
+        self.submitted_at = datetime.now(timezone.utc)
+        self.started_at: datetime | None = None
+        self.completed_at: datetime | None = None
+        self.groups_total: int | None = None
+        self.groups_done = 0
+        self.current_group: str | None = None
+        self.messages_inserted = 0
+        self.result: Any = None
+        self.error: str | None = None
+        self.profile_id: str | None = None
+        self.waiting_for_group: str | None = None
+        self._manager: "JobManager | None" = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in ("queued", "running")
+
+    def group_done(self, group_id: str, inserted: int = 0):
+        self.groups_done += 1
+        self.messages_inserted += inserted
+        if self.current_group == group_id:
+            self.current_group = None
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "groups": self.groups,
+            "from_date": self.from_date,
+            "to_date": self.to_date,
+            "profile": self.profile,
+            "submitted_at": self.submitted_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "completed_at": self.completed_at.isoformat() if self.completed_at else None,
+            "progress": {
+                "groups_total": self.groups_total,
+                "groups_done": self.groups_done,
+                "current_group": self.current_group,
+                "waiting_for_group": self.waiting_for_group,
+                "messages_inserted": self.messages_inserted,
+            },
+            "result": self.result,
+            "error": self.error,
+            "profile_id": self.profile_id,
+        }
+
+
+def current_job() -> Job | None:
+    """The job the calling task runs in, if any."""
+    return _current_job.get()
+
+
+class JobManager:
+    """Runs jobs on the event loop with a concurrency cap and per-group claims."""
+
+    def __init__(self, max_concurrent: int = 2, history_size: int = 100):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+        self.max_concurrent = max_concurrent
+        self.history_size = history_size
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._group_locks: dict[str, asyncio.Lock] = {}
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+
+    def __repr__(self) -> str:
+        return f"JobManager(max_concurrent={self.max_concurrent})"
+
+    def submit(
+        self,
+        job: Job,
+        run: Callable[[Job], Awaitable[Any]],
+        on_done: Callable[[Job], None] | None = None,
+    ) -> Job:
+        """Queue ``run(job)``; returns immediately with the job in ``queued`` state."""
+        job._manager = self
+        self._jobs[job.id] = job
+        self._prune()
+        job._task = asyncio.create_task(self._run(job, run, on_done))
+        job._task.add_done_callback(lambda _: self._mark_unstarted_cancelled(job))
+        return job
+
+    @staticmethod
+    def _mark_unstarted_cancelled(job: Job):
+        # A task cancelled before its first step never enters _run
+        if job.active:
+            job.status = "cancelled"
+            job.completed_at = datetime.now(timezone.utc)
+
+    async def _run(self, job: Job, run, on_done):
+        _current_job.set(job)
+        try:
+            async with self._slots:
+                job.status = "running"
+                job.started_at = datetime.now(timezone.utc)
+                logger.info(f"Job {job.id} ({job.kind}) started")
+                job.result = await run(job)
+            job.status = "success"
+            logger.info(f"Job {job.id} ({job.kind}) completed")
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            logger.warning(f"Job {job.id} ({job.kind}) cancelled")
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            logger.error(f"Job {job.id} ({job.kind}) failed: {e}")
+        finally:
+            job.completed_at = datetime.now(timezone.utc)
+            job.current_group = None
+            job.waiting_for_group = None
+            if on_done is not None:
+                on_done(job)
+
+    def cancel(self, job_id: str) -> Job | None:
+        """Request cancellation; the job ends as ``cancelled`` at its next await."""
+        job = self._jobs.get(job_id)
+        if job is not None and job.active and job._task is not None:
+            job._task.cancel()
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def jobs(self) -> list[Job]:
+        """All remembered jobs, newest first."""
+        return list(reversed(self._jobs.values()))
+
+    def active(self, kind: str | None = None) -> list[Job]:
+        return [
+            job for job in self._jobs.values()
+            if job.active and (kind is None or job.kind == kind)
+        ]
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if not job.active]
+        for job_id in finished[: max(0, len(self._jobs) - self.history_size)]:
+            del self._jobs[job_id]
+
+    @asynccontextmanager
+    async def claim(self, job: Job, group_id: str):
+        lock = self._group_locks.setdefault(group_id, asyncio.Lock())
+        if lock.locked():
+            job.waiting_for_group = group_id
+            logger.info(f"Job {job.id} waiting for group {group_id} held by another job")
+        async with lock:
+            job.waiting_for_group = None
+            job.current_group = group_id
+            yield
+
+
+@asynccontextmanager
+async def claim_group(group_id: str):
+    """Hold ``group_id`` exclusively among jobs; a no-op outside a job."""
+    job = current_job()
+    if job is None or job._manager is None:
+        yield
+        return
+    async with job._manager.claim(job, group_id):
+        yield
@@ -0,0 +1,368 @@
+"""Offline SQLite storage backend with the same tables as the BigQuery pipeline."""
+
+import json
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timezone
+from typing import Any
+
+from telegram_bq_ingest import (
+    CHANGES_SCHEMA,
+    ENGAGEMENT_SCHEMA,
+    MEDIA_SCHEMA,
+    MESSAGES_SCHEMA,
+    METADATA_SCHEMA,
+    RUN_STATS_SCHEMA,
+    MessageRow,
+    extract_telegram_url,
+    extract_urls,
+)
+
+# BigQuery column types mapped to SQLite storage classes. Timestamps are stored
+# as ISO 8601 text (sortable), REPEATED columns as JSON arrays.
+_SQLITE_TYPES = {
+    "STRING": "TEXT",
+    "TIMESTAMP": "TEXT",
+    "INTEGER": "INTEGER",
+    "FLOAT": "REAL",
+    "BOOLEAN": "INTEGER",
+}
+
+# SQLite's default SQLITE_MAX_VARIABLE_NUMBER is 32766 on modern builds,
+# keep well below it for older ones.
+_MAX_QUERY_PARAMS = 900
+
+
+def _create_table_sql(table: str, schema, primary_key: tuple[str, ...] = ()) -> str:
+    columns = []
+    for field in schema:
+        sql_type = "TEXT" if field.mode == "REPEATED" else _SQLITE_TYPES[field.field_type]
+        not_null = " NOT NULL" if field.mode == "REQUIRED" else ""
+        columns.append(f"{field.name} {sql_type}{not_null}")
+    if primary_key:
+        columns.append(f"PRIMARY KEY ({', '.join(primary_key)})")
+    return f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)})"
+
+
+class SQLiteSink:
+    """Storage backend writing to a local SQLite file.
+
+    Implements the same methods as ``telegram_bq_ingest.BigQuerySink`` so the
+    pipeline can run, and be benchmarked, without GCP credentials or BigQuery jobs.
+    A new connection is opened per call because the pipeline calls sinks from
+    worker threads.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        table: str = "telegram_messages",
+        metadata_table: str = "telegram_last_ingestion",
+        groups_table: str = "groups",
+        engagement_table: str = "telegram_engagement",
+        media_table: str = "telegram_media",
+        changes_table: str = "telegram_message_changes",
+        run_stats_table: str = "telegram_run_stats",
+    ):
+        self.path = path
+        self.table = table
+        self.metadata_table = metadata_table
+        self.groups_table = groups_table
+        self.engagement_table = engagement_table
+        self.media_table = media_table
+        self.changes_table = changes_table
+        self.run_stats_table = run_stats_table
+        self._run_plan: list[dict[str, str | int | None]] | None = None
+
+    def __repr__(self) -> str:
+        return f"SQLiteSink({self.path})"
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def ensure_tables(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                _create_table_sql(self.table, MESSAGES_SCHEMA, ("group_id", "message_id"))
+            )
+            self._add_missing_columns(conn, self.table, MESSAGES_SCHEMA)
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table}_timestamp ON {self.table} (timestamp)"
+            )
+            conn.execute(
+                f"""CREATE TABLE IF NOT EXISTS {self.metadata_table} (
+                    group_id TEXT PRIMARY KEY,
+                    last_fetch_time TEXT NOT NULL,
+                    is_first_time INTEGER NOT NULL,
+                    last_message_id INTEGER,
+                    pts INTEGER
+                )"""
+            )
+            self._add_missing_columns(conn, self.metadata_table, METADATA_SCHEMA)
+            conn.execute(
+                f"""CREATE TABLE IF NOT EXISTS {self.groups_table} (
+                    group_id TEXT PRIMARY KEY,
+                    group_link TEXT,
+                    last_fetch_time TEXT,
+                    is_relevant INTEGER
+                )"""
+            )
+            conn.execute(_create_table_sql(self.engagement_table, ENGAGEMENT_SCHEMA))
+            conn.execute(_create_table_sql(self.media_table, MEDIA_SCHEMA))
+            self._add_missing_columns(conn, self.media_table, MEDIA_SCHEMA)
+            conn.execute(_create_table_sql(self.changes_table, CHANGES_SCHEMA))
+            conn.execute(_create_table_sql(self.run_stats_table, RUN_STATS_SCHEMA))
+
+    @staticmethod
+    def _add_missing_columns(conn: sqlite3.Connection, table: str, schema):
+        """Add columns introduced after the table was created."""
+        existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for field in schema:
+            if field.name not in existing:
+                sql_type = "TEXT" if field.mode == "REPEATED" else _SQLITE_TYPES[field.field_type]
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {field.name} {sql_type}")
+
+    def add_group(self, group_id: str, group_link: str, is_relevant: bool = True):
+        """Register a group to scrape, the local equivalent of a `groups` table row."""
+        self.ensure_tables()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                f"""INSERT INTO {self.groups_table} (group_id, group_link, is_relevant)
+                VALUES (?, ?, ?)
+                ON CONFLICT (group_id) DO UPDATE SET
+                  group_link = excluded.group_link, is_relevant = excluded.is_relevant""",
+                (group_id, group_link, is_relevant),
+            )
+
+    def get_entities_data(self) -> list[dict[str, str | int | None]]:
+        """Groups to scrape joined with their cursor, queried once per sink (i.e. per run)."""
+        if self._run_plan is not None:
+            return self._run_plan
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"""SELECT g.group_id, g.group_link,
+                  COALESCE(m.last_fetch_time, g.last_fetch_time) AS last_fetch_time,
+                  m.last_message_id, m.pts
+                FROM {self.groups_table} AS g
+                LEFT JOIN {self.metadata_table} AS m ON m.group_id = g.group_id
+                WHERE (g.is_relevant = 1 OR g.is_relevant IS NULL)
+                  AND g.group_link IS NOT NULL"""
+            ).fetchall()
+        self._run_plan = [
+            {
+                "id": str(row["group_id"]),
+                "link": str(row["group_link"]),
+                "last_fetch_time": row["last_fetch_time"],
+                "last_message_id": row["last_message_id"],
+                "pts": row["pts"],
+            }
+            for row in rows
+        ]
+        return self._run_plan
+
+    def _check_duplicates(
+        self, conn: sqlite3.Connection, messages: list[MessageRow]
+    ) -> list[MessageRow]:
+        """Return only messages whose (message_id, group_id) is not stored yet."""
+        keys = [msg.key for msg in messages]
+        existing: set[tuple[str, str]] = set()
+        for group_id in {group_id for _, group_id in keys}:
+            message_ids = [message_id for message_id, gid in keys if gid == group_id]
+            for start in range(0, len(message_ids), _MAX_QUERY_PARAMS):
+                batch = message_ids[start:start + _MAX_QUERY_PARAMS]
+                placeholders = ", ".join("?" * len(batch))
+                rows = conn.execute(
+                    f"""SELECT message_id FROM {self.table}
+                    WHERE group_id = ? AND message_id IN ({placeholders})""",
+                    [group_id, *batch],
+                )
+                existing.update((row["message_id"], group_id) for row in rows)
+        return [msg for msg, key in zip(messages, keys) if key not in existing]
+
+    def handle_new_messages(self, messages: list[MessageRow], entity_id: str) -> int:
+        with closing(self._connect()) as conn, conn:
+            new_messages = self._check_duplicates(conn, messages)
+            print(f"Found {len(new_messages)} new messages (after duplicate check)")
+            if not new_messages:
+                return 0
+            columns = [field.name for field in MESSAGES_SCHEMA]
+            rows = []
+            for msg in new_messages:
+                row = msg.to_dict()
+                row["links"] = json.dumps(row["links"])
+                rows.append([row[column] for column in columns])
+            conn.executemany(
+                f"INSERT INTO {self.table} ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})",
+                rows,
+            )
+        print(f"✅ Inserted {len(new_messages)} messages for {entity_id}")
+        return len(new_messages)
+
+    def update_metadata(self, group_id: str, messages: list[MessageRow]):
+        if not messages:
+            print(f"No new messages to update for {group_id}")
+            return
+        last_ts = max(m.timestamp for m in messages).isoformat()
+        last_message_id = max(int(m.message_id) for m in messages)
+        with closing(self._connect()) as conn, conn:
+            # The cursor only moves forward, e.g. when re-ingesting an older window
+            conn.execute(
+                f"""INSERT INTO {self.metadata_table}
+                  (group_id, last_fetch_time, is_first_time, last_message_id)
+                VALUES (?, ?, 0, ?)
+                ON CONFLICT (group_id) DO UPDATE SET
+                  last_fetch_time = MAX(last_fetch_time, excluded.last_fetch_time),
+                  last_message_id = MAX(IFNULL(last_message_id, 0), excluded.last_message_id),
+                  is_first_time = 0""",
+                (str(group_id), last_ts, last_message_id),
+            )
+        print(f"Updated metadata for {group_id} to {last_ts} (message {last_message_id})")
+
+    def update_sync_state(self, group_id: str, pts: int):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                f"""INSERT INTO {self.metadata_table}
+                  (group_id, last_fetch_time, is_first_time, pts)
+                VALUES (?, ?, 0, ?)
+                ON CONFLICT (group_id) DO UPDATE SET pts = excluded.pts""",
+                (str(group_id), datetime.now(timezone.utc).isoformat(), pts),
+            )
+        print(f"Updated sync state for {group_id} to pts {pts}")
+
+    def record_message_changes(self, changes: list[dict[str, str | int | list[str] | None]]):
+        if not changes:
+            return
+        columns = [field.name for field in CHANGES_SCHEMA]
+        rows = []
+        for change in changes:
+            row = dict(change, links=json.dumps(change["links"]))
+            rows.append([row[column] for column in columns])
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                f"INSERT INTO {self.changes_table} ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})",
+                rows,
+            )
+        print(f"✅ Recorded {len(changes)} message changes in {self.path}")
+
+    def get_recent_message_ids(self, days: int) -> dict[str, list[int]]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"""SELECT DISTINCT group_id, message_id FROM {self.table}
+                WHERE julianday(timestamp) >= julianday('now', ?)""",
+                (f"-{int(days)} days",),
+            ).fetchall()
+        ids_by_group: dict[str, list[int]] = {}
+        for row in rows:
+            ids_by_group.setdefault(row["group_id"], []).append(int(row["message_id"]))
+        return ids_by_group
+
+    def load_engagement_snapshots(self, snapshots: list[dict[str, str | int | None]]):
+        if not snapshots:
+            print("No engagement snapshots to load")
+            return
+        self.ensure_tables()
+        columns = [field.name for field in ENGAGEMENT_SCHEMA]
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                f"INSERT INTO {self.engagement_table} ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})",
+                [[snapshot[column] for column in columns] for snapshot in snapshots],
+            )
+        print(f"✅ Loaded {len(snapshots)} engagement snapshots into {self.path}")
+
+    def load_media_records(self, records: list[dict[str, str | int | None]]):
+        if not records:
+            return
+        columns = [field.name for field in MEDIA_SCHEMA]
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                f"INSERT INTO {self.media_table} ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})",
+                [[record[column] for column in columns] for record in records],
+            )
+        print(f"✅ Loaded {len(records)} media records into {self.path}")
+
+    def load_run_stats(self, rows: list[dict[str, Any]]):
+        if not rows:
+            return
+        columns = [field.name for field in RUN_STATS_SCHEMA]
+        values = []
+        for row in rows:
+            row = dict(row, stages=json.dumps(row["stages"]))
+            values.append([row[column] for column in columns])
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                f"INSERT INTO {self.run_stats_table} ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})",
+                values,
+            )
+        print(f"✅ Loaded stats for {len(rows)} groups into {self.path}")
+
+    def renormalize_messages(self) -> int:
+        """Recompute text-derived columns of stored messages with the current rules.
+
+        Lets normalization changes be applied to history without re-fetching from
+        Telegram or scanning BigQuery.
+        """
+        with closing(self._connect()) as conn, conn:
+            rows = conn.execute(
+                f"SELECT group_id, message_id, message_text FROM {self.table}"
+            ).fetchall()
+            conn.executemany(
+                f"""UPDATE {self.table} SET links = ?, telegram_url = ?
+                WHERE group_id = ? AND message_id = ?""",
+                [
+                    (
+                        json.dumps(extract_urls(row["message_text"])),
+                        extract_telegram_url(row["message_text"]),
+                        row["group_id"],
+                        row["message_id"],
+                    )
+                    for row in rows
+                ],
+            )
+        print(f"Re-normalized {len(rows)} messages in {self.path}")
+        return len(rows)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from config import load_config
+
+    parser = argparse.ArgumentParser(description="Manage the offline SQLite store")
+    parser.add_argument("--db", help="SQLite file (default: LOCAL_DB_PATH)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add_group_parser = subparsers.add_parser("add-group", help="Register a group to scrape")
+    add_group_parser.add_argument("group_link", help="Group link, e.g. https://t.me/name")
+    add_group_parser.add_argument("--group-id", help="Group id to store (default: the link)")
+    subparsers.add_parser(
+        "renormalize", help="Recompute links/telegram_url of stored messages"
+    )
+    args = parser.parse_args()
+
+    config = load_config()
+    sink = SQLiteSink(
+        args.db or config["LOCAL_DB_PATH"],
+        table=config["BQ_TABLE"],
+        metadata_table=config["BQ_METADATA_TABLE"],
+        groups_table=config["BQ_GROUPS_TABLE"],
+        engagement_table=config["BQ_ENGAGEMENT_TABLE"],
+        media_table=config["BQ_MEDIA_TABLE"],
+        changes_table=config["BQ_CHANGES_TABLE"],
+        run_stats_table=config["BQ_RUN_STATS_TABLE"],
+    )
+    if args.command == "add-group":
+        sink.add_group(args.group_id or args.group_link, args.group_link)
+        print(f"Added group {args.group_link} to {sink.path}")
+    else:
+        sink.ensure_tables()
+        sink.renormalize_messages()
@@ -1,11 +1,30 @@
 import argparse
+import asyncio
 from datetime import datetime, timedelta, timezone
 
+from google.cloud import bigquery
 from loguru import logger
+from telethon import TelegramClient
 
-from bq_utils import get_entities_data_from_bq
 from config import load_config, validate_config
-from telegram_bq_ingest import ingest_telegram_to_bq
+from local_store import SQLiteSink
+from media import GCSMediaStore, LocalMediaStore, MediaDownloader, open_media_store
+from near_dup import NearDupIndex
+from profiling import PROFILE_MODES, RunProfiler
+from telegram_bq_ingest import (
+    SYNC_MODES,
+    BigQuerySink,
+    NormalizationPool,
+    ingest_telegram_to_bq_async,
+    refresh_engagement_async,
+    reingest_window_async,
+)
+
+# How far back groups without an ingestion cursor are fetched
+DEFAULT_BACKFILL_DAYS = 1095
+
+# Near-duplicate indexes by file path, loaded once per process
+_near_dup_indexes: dict[str, NearDupIndex] = {}
 
 
 def parse_args():
@@ -17,18 +36,162 @@ def parse_args():
         help="Start date in ISO format (optional, will use metadata if not provided)",
     )
     parser.add_argument("--to-date", help="End date in ISO format (default: now)")
+    parser.add_argument(
+        "--groups",
+        type=lambda value: [group.strip() for group in value.split(",") if group.strip()],
+        help="Comma-separated group ids or links to process (default: all relevant groups)",
+    )
+    parser.add_argument(
+        "--sink",
+        choices=["bigquery", "sqlite"],
+        help="Storage backend (default: SINK from the environment)",
+    )
+    parser.add_argument(
+        "--takeout",
+        action="store_true",
+        help="Read history through a takeout session (lower flood limits for backfills)",
+    )
+    parser.add_argument(
+        "--sync-mode",
+        choices=SYNC_MODES,
+        help="How groups are brought up to date (default: SYNC_MODE)",
+    )
+    parser.add_argument(
+        "--normalize-workers",
+        type=int,
+        help="Normalize messages in a process pool of this size (default: NORMALIZE_WORKERS)",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=PROFILE_MODES,
+        help="Profile the run and save the result to PROFILES_DIR",
+    )
+    parser.add_argument(
+        "--refresh-engagement",
+        action="store_true",
+        help="Refresh views/replies/forwards of recent messages instead of ingesting",
+    )
+    parser.add_argument(
+        "--reingest",
+        action="store_true",
+        help="Re-read the --from-date/--to-date window for all (or --groups) groups, "
+        "ignoring their cursors",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="Groups re-ingested at once with --reingest (default: REINGEST_CONCURRENCY)",
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        help="Days back to refresh engagement for (default: ENGAGEMENT_REFRESH_DAYS)",
+    )
     return parser.parse_args()
 
 
-def main(from_date: str | None = None, to_date: str | None = None):
+def create_sink(
+    config: dict[str, str | None], bq_client: bigquery.Client | None = None
+) -> BigQuerySink | SQLiteSink:
+    """Build the storage backend selected by the SINK setting."""
+    if config["SINK"] == "sqlite":
+        return SQLiteSink(
+            config["LOCAL_DB_PATH"],
+            table=config["BQ_TABLE"],
+            metadata_table=config["BQ_METADATA_TABLE"],
+            groups_table=config["BQ_GROUPS_TABLE"],
+            engagement_table=config["BQ_ENGAGEMENT_TABLE"],
+            media_table=config["BQ_MEDIA_TABLE"],
+            changes_table=config["BQ_CHANGES_TABLE"],
+            run_stats_table=config["BQ_RUN_STATS_TABLE"],
+        )
+    if bq_client is None:
+        bq_client = bigquery.Client(project=config["BQ_PROJECT_ID"])
+    return BigQuerySink(
+        bq_client,
+        config["BQ_PROJECT_ID"],
+        config["BQ_DATASET"],
+        table=config["BQ_TABLE"],
+        metadata_table=config["BQ_METADATA_TABLE"],
+        groups_table=config["BQ_GROUPS_TABLE"],
+        engagement_table=config["BQ_ENGAGEMENT_TABLE"],
+        media_table=config["BQ_MEDIA_TABLE"],
+        changes_table=config["BQ_CHANGES_TABLE"],
+        run_stats_table=config["BQ_RUN_STATS_TABLE"],
+    )
+
+
+async def shared_near_dup_index(config: dict[str, str | None]) -> NearDupIndex:
+    """The process's near-duplicate index, loaded from NEAR_DUP_INDEX_PATH on first use.
+
+    Concurrent API jobs share it, so each sees the others' messages and saving at
+    the end of one job never drops what another job added.
+    """
+    path = config["NEAR_DUP_INDEX_PATH"]
+    if path not in _near_dup_indexes:
+        index = await asyncio.to_thread(
+            NearDupIndex.load,
+            path,
+            float(config["NEAR_DUP_THRESHOLD"]),
+            float(config["NEAR_DUP_WINDOW_DAYS"]),
+        )
+        # Another job may have loaded it while this one waited
+        _near_dup_indexes.setdefault(path, index)
+    return _near_dup_indexes[path]
+
+
+def select_groups(
+    tg_entities_data: list[dict[str, str | int | None]], group_ids: list[str]
+) -> list[dict[str, str | int | None]]:
+    """Keep the planned groups whose id or link is in ``group_ids``."""
+    wanted = set(group_ids)
+    selected = [
+        entity for entity in tg_entities_data
+        if entity["id"] in wanted or entity["link"] in wanted
+    ]
+    found = {entity["id"] for entity in selected} | {entity["link"] for entity in selected}
+    missing = wanted - found
+    if missing:
+        logger.warning(f"Skipping unknown or irrelevant groups: {', '.join(sorted(missing))}")
+    return selected
+
+
+async def main_async(
+    from_date: str | None = None,
+    to_date: str | None = None,
+    telegram_client: TelegramClient | None = None,
+    bq_client: bigquery.Client | None = None,
+    sink_name: str | None = None,
+    use_takeout: bool = False,
+    normalize_workers: int | None = None,
+    group_ids: list[str] | None = None,
+    sync_mode: str | None = None,
+    normalization_pool: NormalizationPool | None = None,
+    media_store: LocalMediaStore | GCSMediaStore | None = None,
+) -> int:
+    """Run the pipeline on the current event loop.
+
+    Long-lived clients, normalization pool and media store (e.g. owned by the
+    FastAPI lifespan) are reused when given, otherwise fresh ones are created for
+    this run.
+    ``use_takeout`` is meant for large first-time backfills. ``group_ids`` restricts
+    the run to those groups (matched by id or link). ``sync_mode`` overrides
+    SYNC_MODE. Raises ValueError on configuration errors or when there are no
+    groups to run, so a job fails instead of reporting success.
+    """
     config = load_config()
+    if sink_name:
+        config["SINK"] = sink_name
+    if normalize_workers is None:
+        normalize_workers = int(config["NORMALIZE_WORKERS"])
+    if sync_mode:
+        config["SYNC_MODE"] = sync_mode
 
     # Validate configuration
     try:
         validate_config(config)
     except ValueError as e:
-        logger.error(f"Configuration error: {e}")
-        return
+        raise ValueError(f"Configuration error: {e}") from e
 
     # BigQuery configuration
     bq_project = config["BQ_PROJECT_ID"]
@@ -37,14 +200,19 @@ def main(from_date: str | None = None, to_date: str | None = None):
     bq_metadata_table = config["BQ_METADATA_TABLE"]
     bq_groups_table = config["BQ_GROUPS_TABLE"]
 
-    # Fetch groups from BigQuery groups table
-    tg_entities_data = get_entities_data_from_bq(bq_project, bq_dataset, bq_groups_table)
+    # Fetch groups from the groups table
+    sink = create_sink(config, bq_client)
+    await asyncio.to_thread(sink.ensure_tables)
+    tg_entities_data = await asyncio.to_thread(sink.get_entities_data)
     if not tg_entities_data:
-        logger.error(
-            f"No Telegram groups found in {bq_project}.{bq_dataset}.{bq_groups_table}. "
+        raise ValueError(
+            f"No Telegram groups found in {sink} table {bq_groups_table}. "
             "Please ensure the table exists and contains groups with group_link values."
         )
-        return
+    if group_ids:
+        tg_entities_data = select_groups(tg_entities_data, group_ids)
+        if not tg_entities_data:
+            raise ValueError(f"None of the requested groups are in {sink}: {', '.join(group_ids)}")
 
     # Telegram configuration
     telegram_config = {
@@ -52,25 +220,52 @@ def main(from_date: str | None = None, to_date: str | None = None):
         "TELEGRAM_API_HASH": config["TELEGRAM_API_HASH"],
     }
 
-    # Date range (default: last 365 days if not provided)
-    if not from_date:
-        from_date = (datetime.now(timezone.utc) - timedelta(days=1095)).isoformat()
+    # Date range: groups resume from their cursor in the metadata table; groups
+    # seen for the first time are backfilled over the last 3 years
+    default_from_date = (
+        datetime.now(timezone.utc) - timedelta(days=DEFAULT_BACKFILL_DAYS)
+    ).isoformat()
     if not to_date:
         to_date = datetime.now(timezone.utc).isoformat()
 
-    logger.info("Starting Telegram to BigQuery ingestion...")
+    logger.info(f"Starting Telegram ingestion into {sink}...")
     if from_date:
-        logger.info(f"Using date range: {from_date} to {to_date}")
+        logger.info(
+            f"Using date range: {from_date} to {to_date} "
+            "(groups whose cursor is later resume from their cursor)"
+        )
     else:
         logger.info(
-            f"Using metadata table {bq_project}.{bq_dataset}.{bq_metadata_table} for incremental fetching to {to_date}"
+            f"Using metadata table {bq_metadata_table} for incremental fetching to {to_date} "
+            f"(new groups from {default_from_date})"
         )
     logger.info(
         "Pipeline will: Fetch new messages → Check duplicates → Insert only new messages → Update metadata"
     )
 
+    near_dup_index = None
+    if config["NEAR_DUP_ENABLED"].lower() == "true":
+        near_dup_index = await shared_near_dup_index(config)
+        logger.info(f"Near-duplicate index has {len(near_dup_index)} signatures")
+
+    media_downloader = None
+    if config["MEDIA_ENABLED"].lower() == "true":
+        if media_store is None:
+            # Creating a Cloud Storage client looks up credentials, which can block
+            media_store = await asyncio.to_thread(open_media_store, config["MEDIA_STORE"])
+        media_downloader = MediaDownloader(
+            media_store,
+            workers=int(config["MEDIA_WORKERS"]),
+            max_bytes=int(config["MEDIA_MAX_BYTES"]),
+            queue_size=int(config["MEDIA_QUEUE_SIZE"]),
+            mime_prefixes=tuple(
+                prefix.strip() for prefix in config["MEDIA_TYPES"].split(",") if prefix.strip()
+            ),
+        )
+        logger.info(f"Downloading media with {media_downloader}")
+
     try:
-        total_inserted = ingest_telegram_to_bq(
+        total_inserted = await ingest_telegram_to_bq_async(
             tg_entities_data=tg_entities_data,
             bq_project=bq_project,
             bq_dataset=bq_dataset,
@@ -79,6 +274,16 @@ def main(from_date: str | None = None, to_date: str | None = None):
             telegram_config=telegram_config,
             from_date=from_date,
             to_date=to_date,
+            telegram_client=telegram_client,
+            sink=sink,
+            use_takeout=use_takeout,
+            normalize_workers=normalize_workers,
+            normalize_batch_size=int(config["NORMALIZE_BATCH_SIZE"]),
+            normalization_pool=normalization_pool,
+            near_dup_index=near_dup_index,
+            default_from_date=default_from_date,
+            media_downloader=media_downloader,
+            sync_mode=config["SYNC_MODE"],
         )
         logger.info("✅ Pipeline completed successfully!")
         logger.info(f"📊 Total messages inserted: {total_inserted}")
@@ -87,8 +292,200 @@ def main(from_date: str | None = None, to_date: str | None = None):
     except Exception as e:
         logger.error(f"❌ Error during ingestion: {e}")
         raise
+    finally:
+        if near_dup_index is not None:
+            await asyncio.to_thread(near_dup_index.save, config["NEAR_DUP_INDEX_PATH"])
+    return total_inserted
+
+
+async def reingest_main_async(
+    from_date: str,
+    to_date: str,
+    telegram_client: TelegramClient | None = None,
+    bq_client: bigquery.Client | None = None,
+    sink_name: str | None = None,
+    group_ids: list[str] | None = None,
+    use_takeout: bool = False,
+    concurrency: int | None = None,
+    normalization_pool: NormalizationPool | None = None,
+) -> int:
+    """Re-ingest a bounded date window for all (or the given) groups.
+
+    Raises ValueError like ``main_async``.
+    """
+    config = load_config()
+    if sink_name:
+        config["SINK"] = sink_name
+    if concurrency is None:
+        concurrency = int(config["REINGEST_CONCURRENCY"])
+
+    try:
+        validate_config(config)
+    except ValueError as e:
+        raise ValueError(f"Configuration error: {e}") from e
+
+    sink = create_sink(config, bq_client)
+    await asyncio.to_thread(sink.ensure_tables)
+    tg_entities_data = await asyncio.to_thread(sink.get_entities_data)
+    if group_ids:
+        tg_entities_data = select_groups(tg_entities_data, group_ids)
+    if not tg_entities_data:
+        raise ValueError(f"No Telegram groups to re-ingest in {sink}")
+
+    logger.info(
+        f"Re-ingesting {from_date} to {to_date} for {len(tg_entities_data)} groups "
+        f"into {sink}, {concurrency} at a time..."
+    )
+    try:
+        total_inserted = await reingest_window_async(
+            tg_entities_data=tg_entities_data,
+            from_date=from_date,
+            to_date=to_date,
+            sink=sink,
+            telegram_config={
+                "TELEGRAM_API_ID": config["TELEGRAM_API_ID"],
+                "TELEGRAM_API_HASH": config["TELEGRAM_API_HASH"],
+            },
+            telegram_client=telegram_client,
+            concurrency=concurrency,
+            use_takeout=use_takeout,
+            normalize_workers=int(config["NORMALIZE_WORKERS"]),
+            normalize_batch_size=int(config["NORMALIZE_BATCH_SIZE"]),
+            normalization_pool=normalization_pool,
+        )
+        logger.info(f"📊 Missing messages inserted: {total_inserted}")
+    except Exception as e:
+        logger.error(f"❌ Error during re-ingest: {e}")
+        raise
+    return total_inserted
+
+
+async def refresh_engagement_main_async(
+    days: int | None = None,
+    telegram_client: TelegramClient | None = None,
+    bq_client: bigquery.Client | None = None,
+    sink_name: str | None = None,
+    group_ids: list[str] | None = None,
+) -> int:
+    """Append fresh engagement snapshots for recent messages of all (or the given) groups.
+
+    Raises ValueError like ``main_async``.
+    """
+    config = load_config()
+    if sink_name:
+        config["SINK"] = sink_name
+
+    try:
+        validate_config(config)
+    except ValueError as e:
+        raise ValueError(f"Configuration error: {e}") from e
+
+    if days is None:
+        days = int(config["ENGAGEMENT_REFRESH_DAYS"])
+
+    sink = create_sink(config, bq_client)
+    await asyncio.to_thread(sink.ensure_tables)
+    tg_entities_data = await asyncio.to_thread(sink.get_entities_data)
+    if not tg_entities_data:
+        raise ValueError(
+            f"No Telegram groups found in {sink} table {config['BQ_GROUPS_TABLE']}."
+        )
+    if group_ids:
+        tg_entities_data = select_groups(tg_entities_data, group_ids)
+        if not tg_entities_data:
+            raise ValueError(f"None of the requested groups are in {sink}: {', '.join(group_ids)}")
+
+    logger.info(f"Refreshing engagement counters for the last {days} days...")
+    try:
+        total_snapshots = await refresh_engagement_async(
+            tg_entities_data=tg_entities_data,
+            bq_project=config["BQ_PROJECT_ID"],
+            bq_dataset=config["BQ_DATASET"],
+            days=days,
+            telegram_config={
+                "TELEGRAM_API_ID": config["TELEGRAM_API_ID"],
+                "TELEGRAM_API_HASH": config["TELEGRAM_API_HASH"],
+            },
+            telegram_client=telegram_client,
+            sink=sink,
+        )
+        logger.info(f"📊 Engagement snapshots written: {total_snapshots}")
+    except Exception as e:
+        logger.error(f"❌ Error during engagement refresh: {e}")
+        raise
+    return total_snapshots
+
+
+async def run_profiled(pipeline, profile: str | None = None, **kwargs):
+    """Await ``pipeline(**kwargs)``, under a RunProfiler when ``profile`` is set."""
+    if not profile:
+        return await pipeline(**kwargs)
+    async with RunProfiler(profile, load_config()["PROFILES_DIR"]) as profiler:
+        result = await pipeline(**kwargs)
+    logger.info(f"Profile saved as {profiler.profile_id}")
+    return result
+
+
+def main(
+    from_date: str | None = None,
+    to_date: str | None = None,
+    sink_name: str | None = None,
+    use_takeout: bool = False,
+    normalize_workers: int | None = None,
+    profile: str | None = None,
+    group_ids: list[str] | None = None,
+    sync_mode: str | None = None,
+) -> int:
+    return asyncio.run(
+        run_profiled(
+            main_async,
+            profile,
+            from_date=from_date,
+            to_date=to_date,
+            sink_name=sink_name,
+            use_takeout=use_takeout,
+            normalize_workers=normalize_workers,
+            group_ids=group_ids,
+            sync_mode=sync_mode,
+        )
+    )
 
 
 if __name__ == "__main__":
     args = parse_args()
-    main(from_date=args.from_date, to_date=args.to_date)
+    if args.reingest:
+        if not (args.from_date and args.to_date):
+            raise SystemExit("--reingest needs both --from-date and --to-date")
+        asyncio.run(
+            run_profiled(
+                reingest_main_async,
+                args.profile,
+                from_date=args.from_date,
+                to_date=args.to_date,
+                sink_name=args.sink,
+                group_ids=args.groups,
+                use_takeout=args.takeout,
+                concurrency=args.concurrency,
+            )
+        )
+    elif args.refresh_engagement:
+        asyncio.run(
+            run_profiled(
+                refresh_engagement_main_async,
+                args.profile,
+                days=args.days,
+                sink_name=args.sink,
+                group_ids=args.groups,
+            )
+        )
+    else:
+        main(
+            from_date=args.from_date,
+            to_date=args.to_date,
+            sink_name=args.sink,
+            use_takeout=args.takeout,
+            normalize_workers=args.normalize_workers,
+            profile=args.profile,
+            group_ids=args.groups,
+            sync_mode=args.sync_mode,
+        )
@@ -0,0 +1,267 @@
+"""Media metadata and background downloads into a content-addressed store.
+
+Every message row records its media's Telegram id, size and MIME type. When
+downloads are enabled, media passing the size/type filters gets a ``media_url``
+pointing into the media store and is downloaded by a small pool of worker tasks
+fed from a queue. The ingest loop only enqueues, so downloads never hold up text
+ingestion.
+
+Stored objects are keyed by the Telegram photo/document id, which Telegram keeps
+when a file is forwarded or reposted: a file is stored (and downloaded) once, no
+matter how many messages share it. The SHA-256 of each downloaded file is
+recorded in the media table.
+
+The queue is bounded and holds only file locations, not messages. When it is full,
+further media of the run are skipped rather than stalling ingestion, and their rows
+get no ``media_url``. A download that fails is recorded in the media table with its
+``error``, so rows pointing at that URL can be told apart (and retried later).
+"""
+
+import asyncio
+import hashlib
+import mimetypes
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator
+
+from telethon import utils
+from telethon.tl.types import MessageMediaDocument, MessageMediaPhoto
+
+PHOTO_MIME_TYPE = "image/jpeg"
+
+
+def media_info(message) -> tuple[str | None, int | None, str | None]:
+    """``(media_id, size, mime_type)`` of a message's photo or document, if any."""
+    media = getattr(message, "media", None)
+    if isinstance(media, MessageMediaPhoto) and media.photo is not None:
+        sizes = [
+            getattr(size, "size", None) or max(getattr(size, "sizes", None) or [0])
+            for size in getattr(media.photo, "sizes", ())
+        ]
+        return str(media.photo.id), max(sizes, default=None) or None, PHOTO_MIME_TYPE
+    if isinstance(media, MessageMediaDocument) and media.document is not None:
+        document = media.document
+        return (
+            str(document.id),
+            getattr(document, "size", None),
+            getattr(document, "mime_type", None),
+        )
+    return None, None, None
+
+
+def media_key(media_id: str, mime_type: str | None) -> str:
+    """Store key of a media object: its Telegram id plus an extension for the MIME type."""
+    extension = mimetypes.guess_extension(mime_type or "") or ""
+    return f"{media_id}{extension}"
+
+
+class LocalMediaStore:
+    """Media store on the local filesystem, sharded by the id's last two digits."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def __repr__(self) -> str:
+        return f"LocalMediaStore({self.root})"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key.partition(".")[0][-2:], key)
+
+    def url(self, key: str) -> str:
+        return os.path.abspath(self._path(key))
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self._path(key))
+
+    def save(self, key: str, data: bytes, mime_type: str | None = None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+class GCSMediaStore:
+    """Media store in a Cloud Storage bucket (needs google-cloud-storage)."""
+
+    def __init__(self, location: str):
+        try:
+            from google.cloud import storage
+        except ImportError as e:
+            raise RuntimeError(
+                "MEDIA_STORE points to Cloud Storage but google-cloud-storage is not installed"
+            ) from e
+        bucket_name, _, prefix = location.removeprefix("gs://").partition("/")
+        self.location = location
+        self.prefix = prefix.strip("/")
+        self.bucket = storage.Client().bucket(bucket_name)
+
+    def __repr__(self) -> str:
+        return f"GCSMediaStore({self.location})"
+
+    def _name(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def url(self, key: str) -> str:
+        return f"gs://{self.bucket.name}/{self._name(key)}"
+
+    def exists(self, key: str) -> bool:
+        return self.bucket.blob(self._name(key)).exists()
+
+    def save(self, key: str, data: bytes, mime_type: str | None = None):
+        self.bucket.blob(self._name(key)).upload_from_string(data, content_type=mime_type)
+
+
+def open_media_store(location: str) -> LocalMediaStore | GCSMediaStore:
+    """Media store for a ``gs://bucket/prefix`` URL or a local directory."""
+    if location.startswith("gs://"):
+        return GCSMediaStore(location)
+    return LocalMediaStore(location)
+
+
+class MediaDownloader:
+    """Downloads message media into a store with a bounded pool of worker tasks.
+
+    Use ``run(client)`` around an ingestion run; on exit it waits for the queued
+    downloads to finish. ``records`` then holds one row per newly stored file and
+    per failed download.
+    """
+
+    def __init__(
+        self,
+        store: LocalMediaStore | GCSMediaStore,
+        workers: int = 4,
+        max_bytes: int = 20_000_000,
+        mime_prefixes: tuple[str, ...] = ("image/", "video/"),
+        queue_size: int = 1000,
+    ):
+        self.store = store
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_bytes = max_bytes
+        self.mime_prefixes = mime_prefixes
+        self.records: list[dict[str, str | int | None]] = []
+        self.downloaded = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue: asyncio.Queue | None = None
+        self._queued_keys: set[str] = set()
+
+    def __repr__(self) -> str:
+        return f"MediaDownloader({self.store}, workers={self.workers})"
+
+    def wants(self, size: int | None, mime_type: str | None) -> bool:
+        """Whether media of this size and type passes the download filters."""
+        if size is None or size > self.max_bytes:
+            return False
+        return bool(mime_type) and mime_type.startswith(self.mime_prefixes)
+
+    def annotate(self, messages) -> int:
+        """Set ``media_url`` on MessageRows whose media was queued for the store.
+
+        Media filtered out or dropped from a full queue get no URL.
+        """
+        annotated = 0
+        for message in messages:
+            if not message.media_id:
+                continue
+            key = media_key(message.media_id, message.media_mime_type)
+            if key in self._queued_keys:
+                message.media_url = self.store.url(key)
+                annotated += 1
+        return annotated
+
+    async def tap(self, messages: AsyncIterator[Any]) -> AsyncIterator[Any]:
+        """Pass Telethon messages through, queueing media downloads on the way."""
+        async for message in messages:
+            self.enqueue(message)
+            yield message
+
+    def enqueue(self, message):
+        media_id, size, mime_type = media_info(message)
+        if media_id is None or self._queue is None:
+            return
+        if not self.wants(size, mime_type):
+            self.skipped += 1
+            return
+        key = media_key(media_id, mime_type)
+        # Reposts within a run share the key and are queued once
+        if key in self._queued_keys:
+            return
+        try:
+            dc_id, location = utils.get_input_location(message.media)
+        except (TypeError, IndexError):
+            self.skipped += 1
+            return
+        try:
+            self._queue.put_nowait((key, media_id, mime_type, size, dc_id, location))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return
+        self._queued_keys.add(key)
+
+    async def _worker(self, client):
+        while True:
+            key, media_id, mime_type, size, dc_id, location = await self._queue.get()
+            try:
+                if await asyncio.to_thread(self.store.exists, key):
+                    continue
+                data = await client.download_file(
+                    location, file=bytes, dc_id=dc_id, file_size=size
+                )
+                if not data:
+                    raise ValueError("empty download")
+                await asyncio.to_thread(self.store.save, key, data, mime_type)
+                self.downloaded += 1
+                self.records.append(
+                    {
+                        "media_id": media_id,
+                        "media_url": self.store.url(key),
+                        "mime_type": mime_type,
+                        "size": len(data),
+                        "sha256": hashlib.sha256(data).hexdigest(),
+                        "stored_at": datetime.now(timezone.utc).isoformat(),
+                        "error": None,
+                    }
+                )
+            except Exception as e:
+                self.failed += 1
+                print(f"⚠ Could not download media {key}: {e}")
+                self.records.append(
+                    {
+                        "media_id": media_id,
+                        "media_url": self.store.url(key),
+                        "mime_type": mime_type,
+                        "size": None,
+                        "sha256": None,
+                        "stored_at": None,
+                        "error": str(e),
+                    }
+                )
+            finally:
+                self._queue.task_done()
+
+    @asynccontextmanager
+    async def run(self, client):
+        """Start the workers; on exit wait for queued downloads, then stop them."""
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        workers = [
+            asyncio.create_task(self._worker(client)) for _ in range(self.workers)
+        ]
+        try:
+            yield self
+            if not self._queue.empty():
+                print(f"Waiting for {self._queue.qsize()} queued media downloads...")
+            await self._queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self._queue = None
+            print(
+                f"Media: {self.downloaded} downloaded, {self.skipped} filtered out, "
+                f"{self.dropped} dropped (queue full), {self.failed} failed"
+            )
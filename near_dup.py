@@ -0,0 +1,271 @@
+"""Near-duplicate (repost) detection with MinHash signatures and a banded LSH index.
+
+Every message text gets a ``content_hash`` (hash of its normalized words, equal for
+exact copies) and, when it has enough words, a MinHash signature over word
+shingles. The signature is computed with one-permutation hashing: each shingle is
+hashed once and kept if it is the minimum of its bin, so the cost is linear in the
+text length rather than in the number of permutations.
+
+Signatures are split into bands; two texts become candidates when a whole band
+matches, and a candidate is a near-duplicate when the share of equal signature
+values (an estimate of the shingle Jaccard similarity) reaches ``threshold``.
+
+The index only remembers a sliding window of recent messages (by message time) and
+can be persisted between runs to a local file or a ``gs://bucket/path`` object.
+Concurrent runs may share one index: ``annotate`` and ``save`` hold its lock.
+"""
+
+import base64
+import heapq
+import json
+import os
+import re
+import threading
+from array import array
+from datetime import datetime
+from functools import cache
+from hashlib import blake2b
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+_EMPTY_BIN = 1 << 16
+
+
+@cache
+def _storage_client():
+    try:
+        from google.cloud import storage
+    except ImportError as e:
+        raise RuntimeError(
+            "NEAR_DUP_INDEX_PATH points to Cloud Storage but google-cloud-storage is not installed"
+        ) from e
+    return storage.Client()
+
+
+def _gcs_blob(location: str):
+    bucket_name, _, name = location.removeprefix("gs://").partition("/")
+    return _storage_client().bucket(bucket_name).blob(name)
+
+
+def _tokens(text: str | None) -> list[str]:
+    return _TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+def content_hash(text: str | None) -> str | None:
+    """Hash of the text's lowercased words; identical for exact reposts."""
+    tokens = _tokens(text)
+    if not tokens:
+        return None
+    return blake2b(" ".join(tokens).encode(), digest_size=8).hexdigest()
+
+
+def minhash_signature(
+    text: str | None,
+    num_perm: int = 32,
+    shingle_size: int = 2,
+    min_tokens: int = 5,
+) -> tuple[int, ...] | None:
+    """One-permutation MinHash of the text's word shingles, 16 bits per value.
+
+    Texts shorter than ``min_tokens`` words return None: their similarity is not
+    meaningful ("ok", "thanks!") and exact copies are caught by ``content_hash``.
+    """
+    tokens = _tokens(text)
+    if len(tokens) < min_tokens:
+        return None
+    bins = [_EMPTY_BIN] * num_perm
+    for i in range(len(tokens) - shingle_size + 1):
+        h = int.from_bytes(
+            blake2b(" ".join(tokens[i:i + shingle_size]).encode(), digest_size=8).digest(),
+            "little",
+        )
+        index = h % num_perm
+        value = (h >> 32) & 0xFFFF
+        if value < bins[index]:
+            bins[index] = value
+    # Fill empty bins from the next non-empty one (rotation densification), so
+    # short texts still produce comparable signatures.
+    for index in range(num_perm):
+        if bins[index] == _EMPTY_BIN:
+            offset = 1
+            while bins[(index + offset) % num_perm] == _EMPTY_BIN:
+                offset += 1
+            bins[index] = bins[(index + offset) % num_perm]
+    return tuple(bins)
+
+
+class NearDupIndex:
+    """In-memory LSH index of recent message signatures with windowed eviction."""
+
+    def __init__(
+        self,
+        threshold: float = 0.7,
+        window_days: float = 7,
+        num_perm: int = 32,
+        bands: int = 8,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.window_seconds = window_days * 86400
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self._min_matches = threshold * num_perm
+        self._entries: dict[int, tuple[tuple[int, ...], str, float]] = {}
+        # (timestamp, entry id) min-heap: messages arrive in no particular time
+        # order across groups, so eviction goes by message time, not insertion
+        self._expiry: list[tuple[float, int]] = []
+        self._buckets: list[dict[tuple[int, ...], list[int]]] = [
+            {} for _ in range(bands)
+        ]
+        self._next_id = 0
+        self._newest = float("-inf")
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _band_keys(self, signature: tuple[int, ...]):
+        rows = self.rows
+        for band in range(self.bands):
+            yield band, signature[band * rows:(band + 1) * rows]
+
+    def signature(self, text: str | None) -> tuple[int, ...] | None:
+        return minhash_signature(text, self.num_perm)
+
+    def lookup(self, signature: tuple[int, ...]) -> str | None:
+        """Return the reference of the most similar indexed text above the threshold."""
+        candidates = set()
+        for band, key in self._band_keys(signature):
+            candidates.update(self._buckets[band].get(key, ()))
+        best_reference = None
+        best_matches = self._min_matches
+        for entry_id in candidates:
+            other, reference, _ = self._entries[entry_id]
+            matches = sum(a == b for a, b in zip(signature, other))
+            if matches >= best_matches:
+                best_matches = matches
+                best_reference = reference
+        return best_reference
+
+    def add(self, signature: tuple[int, ...], reference: str, timestamp: float):
+        # Already outside the window (e.g. a backfill after a recent group)
+        if timestamp < self._newest - self.window_seconds:
+            return
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = (signature, reference, timestamp)
+        heapq.heappush(self._expiry, (timestamp, entry_id))
+        for band, key in self._band_keys(signature):
+            self._buckets[band].setdefault(key, []).append(entry_id)
+        if timestamp > self._newest:
+            self._newest = timestamp
+            self._evict()
+
+    def _evict(self):
+        cutoff = self._newest - self.window_seconds
+        while self._expiry and self._expiry[0][0] < cutoff:
+            _, entry_id = heapq.heappop(self._expiry)
+            signature, _, _ = self._entries.pop(entry_id)
+            for band, key in self._band_keys(signature):
+                bucket = self._buckets[band][key]
+                bucket.remove(entry_id)
+                if not bucket:
+                    del self._buckets[band][key]
+
+    def check(
+        self, signature: tuple[int, ...], reference: str, timestamp: datetime
+    ) -> str | None:
+        """Look ``signature`` up and index it if new. Returns the original's reference."""
+        original = self.lookup(signature)
+        if original is None:
+            self.add(signature, reference, timestamp.timestamp())
+        # A re-fetched message matches its own earlier entry
+        return original if original != reference else None
+
+    def annotate(self, messages) -> int:
+        """Set ``content_hash`` and ``near_dup_of`` on MessageRows; returns near-dup count."""
+        with self._lock:
+            return self._annotate(messages)
+
+    def _annotate(self, messages) -> int:
+        near_dups = 0
+        for message in messages:
+            message.content_hash = content_hash(message.message_text)
+            signature = self.signature(message.message_text)
+            if signature is None:
+                continue
+            message.near_dup_of = self.check(
+                signature,
+                f"{message.group_id}/{message.message_id}",
+                message.timestamp,
+            )
+            if message.near_dup_of is not None:
+                near_dups += 1
+        return near_dups
+
+    def save(self, path: str):
+        """Write the index atomically to a file or ``gs://`` object.
+
+        Signatures are packed as base64 uint16 arrays.
+        """
+        with self._lock:
+            data = json.dumps(self._dump())
+        if path.startswith("gs://"):
+            _gcs_blob(path).upload_from_string(data, content_type="application/json")
+            return
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _dump(self) -> dict:
+        entries = list(self._entries.values())
+        signatures = array("H", (value for signature, _, _ in entries for value in signature))
+        timestamps = array("d", (timestamp for _, _, timestamp in entries))
+        return {
+            "num_perm": self.num_perm,
+            "references": [reference for _, reference, _ in entries],
+            "signatures": base64.b64encode(signatures.tobytes()).decode(),
+            "timestamps": base64.b64encode(timestamps.tobytes()).decode(),
+        }
+
+    @classmethod
+    def load(
+        cls,
+        path: str,
+        threshold: float = 0.7,
+        window_days: float = 7,
+        num_perm: int = 32,
+        bands: int = 8,
+    ) -> "NearDupIndex":
+        """Load a saved index (file or ``gs://`` object), or start an empty one if there is
+        none (or it is stale).
+        """
+        index = cls(threshold, window_days, num_perm, bands)
+        if path.startswith("gs://"):
+            blob = _gcs_blob(path)
+            if not blob.exists():
+                return index
+            data = json.loads(blob.download_as_bytes())
+        else:
+            if not os.path.isfile(path):
+                return index
+            with open(path) as f:
+                data = json.load(f)
+        if data["num_perm"] != num_perm:
+            return index
+        signatures = array("H")
+        signatures.frombytes(base64.b64decode(data["signatures"]))
+        timestamps = array("d")
+        timestamps.frombytes(base64.b64decode(data["timestamps"]))
+        for i, reference in enumerate(data["references"]):
+            index.add(
+                tuple(signatures[i * num_perm:(i + 1) * num_perm]),
+                reference,
+                timestamps[i],
+            )
+        return index
@@ -0,0 +1,338 @@
+"""On-demand profiling of pipeline runs.
+
+A run wrapped in ``RunProfiler`` is recorded either with cProfile (deterministic,
+higher overhead) or with a sampling thread that snapshots the event loop thread's
+stack every few milliseconds (low overhead, safe for production runs). Awaits on
+Telegram and the sink are timed separately through ``track_await``/``timed_iter``,
+since neither profiler attributes time spent waiting on the network. The same
+timings feed the per-group stage times of ``run_stats``.
+
+Each run writes two files to the profiles directory: the raw artifact (``.prof``
+for cProfile, collapsed stacks ``.folded`` for sampling) and a ``.json`` summary
+with the top-N hotspots and the await timings.
+
+Both profilers watch the whole event loop thread, so only one run is profiled at
+a time, and a profile also contains the work of other jobs running meanwhile.
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator
+
+from loguru import logger
+
+from run_stats import GroupStats, current_group_stats
+
+PROFILE_MODES = ("cprofile", "sampling")
+
+_active_profiler: ContextVar["RunProfiler | None"] = ContextVar(
+    "active_profiler", default=None
+)
+
+# The profiler currently recording the event loop thread, if any
+_running_profiler: "RunProfiler | None" = None
+
+PROFILE_SCOPE = (
+    "Whole process: includes the work of any other job running at the same time"
+)
+
+
+class _StackSampler:
+    """Samples one thread's Python stack on a background thread."""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="run-profiler-sampler", daemon=True
+        )
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def profiling_active() -> bool:
+    """Whether a run is being profiled; a second one would corrupt both profiles."""
+    return _running_profiler is not None
+
+
+class RunProfiler:
+    """Async context manager that profiles everything run inside it.
+
+    ``run_id`` (the job id for API jobs) makes the profile id unique even for runs
+    started in the same second. Entering while another run is profiled raises.
+    """
+
+    def __init__(
+        self,
+        mode: str = "cprofile",
+        profiles_dir: str = "profiles",
+        top_n: int = 30,
+        sample_interval: float = 0.005,
+        run_id: str | None = None,
+    ):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode} (expected one of {PROFILE_MODES})")
+        self.mode = mode
+        self.profiles_dir = profiles_dir
+        self.top_n = top_n
+        self.sample_interval = sample_interval
+        self.started_at = datetime.now(timezone.utc)
+        run_id = run_id or uuid.uuid4().hex[:12]
+        self.profile_id = f"{self.started_at.strftime('%Y%m%dT%H%M%S')}-{run_id}-{mode}"
+        self.await_timings: dict[str, dict[str, float]] = {}
+        self.summary: dict[str, Any] | None = None
+        self._profile: cProfile.Profile | None = None
+        self._sampler: _StackSampler | None = None
+        self._start = 0.0
+
+    def record_await(self, label: str, seconds: float):
+        timing = self.await_timings.setdefault(
+            label, {"count": 0, "total_s": 0.0, "max_s": 0.0}
+        )
+        timing["count"] += 1
+        timing["total_s"] += seconds
+        timing["max_s"] = max(timing["max_s"], seconds)
+
+    async def __aenter__(self) -> "RunProfiler":
+        global _running_profiler
+        if _running_profiler is not None:
+            raise RuntimeError(
+                f"Run {_running_profiler.profile_id} is already being profiled"
+            )
+        _running_profiler = self
+        self._token = _active_profiler.set(self)
+        self._start = time.perf_counter()
+        if self.mode == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._sampler = _StackSampler(threading.get_ident(), self.sample_interval)
+            self._sampler.start()
+        logger.info(f"Profiling run as {self.profile_id}")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        global _running_profiler
+        if self._profile is not None:
+            self._profile.disable()
+        if self._sampler is not None:
+            self._sampler.stop()
+        duration = time.perf_counter() - self._start
+        _active_profiler.reset(self._token)
+        _running_profiler = None
+        try:
+            self._save(duration, failed=exc_type is not None)
+        except Exception as e:
+            logger.error(f"Could not save profile {self.profile_id}: {e}")
+        return False
+
+    def _cprofile_hotspots(self, artifact_path: str) -> list[dict[str, Any]]:
+        self._profile.dump_stats(artifact_path)
+        stats = pstats.Stats(self._profile)
+        hotspots = [
+            {
+                "function": f"{func} ({os.path.basename(filename)}:{line})",
+                "calls": calls,
+                "self_s": round(self_time, 6),
+                "cumulative_s": round(cumulative_time, 6),
+            }
+            for (filename, line, func), (
+                _,
+                calls,
+                self_time,
+                cumulative_time,
+                _,
+            ) in stats.stats.items()
+        ]
+        hotspots.sort(key=lambda h: h["cumulative_s"], reverse=True)
+        return hotspots[: self.top_n]
+
+    def _sampling_hotspots(self, artifact_path: str) -> list[dict[str, Any]]:
+        stacks = self._sampler.stacks
+        with open(artifact_path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+        total = sum(stacks.values()) or 1
+        self_samples: Counter[str] = Counter()
+        cumulative_samples: Counter[str] = Counter()
+        for stack, count in stacks.items():
+            self_samples[stack[-1]] += count
+            for function in set(stack):
+                cumulative_samples[function] += count
+        return [
+            {
+                "function": function,
+                "samples": count,
+                "self_pct": round(100 * self_samples[function] / total, 2),
+                "cumulative_pct": round(100 * count / total, 2),
+            }
+            for function, count in cumulative_samples.most_common(self.top_n)
+        ]
+
+    def _save(self, duration: float, failed: bool):
+        os.makedirs(self.profiles_dir, exist_ok=True)
+        extension = "prof" if self.mode == "cprofile" else "folded"
+        artifact_path = os.path.join(self.profiles_dir, f"{self.profile_id}.{extension}")
+        if self.mode == "cprofile":
+            hotspots = self._cprofile_hotspots(artifact_path)
+        else:
+            hotspots = self._sampling_hotspots(artifact_path)
+
+        self.summary = {
+            "id": self.profile_id,
+            "mode": self.mode,
+            "started_at": self.started_at.isoformat(),
+            "duration_s": round(duration, 3),
+            "failed": failed,
+            "scope": PROFILE_SCOPE,
+            "artifact": os.path.basename(artifact_path),
+            "hotspots": hotspots,
+            "await_timings": {
+                label: {
+                    "count": timing["count"],
+                    "total_s": round(timing["total_s"], 6),
+                    "max_s": round(timing["max_s"], 6),
+                }
+                for label, timing in sorted(
+                    self.await_timings.items(),
+                    key=lambda item: item[1]["total_s"],
+                    reverse=True,
+                )
+            },
+        }
+        with open(os.path.join(self.profiles_dir, f"{self.profile_id}.json"), "w") as f:
+            json.dump(self.summary, f, indent=2)
+        logger.info(f"Saved profile {self.profile_id} to {self.profiles_dir}")
+
+
+@asynccontextmanager
+async def track_await(label: str):
+    """Time the awaits inside the block under ``label``.
+
+    Timings go to the active profiler and to the current group's run stats, if
+    either is set; otherwise this is a no-op.
+    """
+    profiler = _active_profiler.get()
+    group_stats = current_group_stats()
+    if profiler is None and group_stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(profiler, group_stats, label, time.perf_counter() - start)
+
+
+def timed_iter(label: str, iterator: AsyncIterator[Any]) -> AsyncIterator[Any]:
+    """Time each ``__anext__`` of an async iterator, like ``track_await``."""
+    profiler = _active_profiler.get()
+    group_stats = current_group_stats()
+    if profiler is None and group_stats is None:
+        return iterator
+    return _timed_iter(profiler, group_stats, label, iterator)
+
+
+def _record(
+    profiler: RunProfiler | None,
+    group_stats: GroupStats | None,
+    label: str,
+    seconds: float,
+):
+    if profiler is not None:
+        profiler.record_await(label, seconds)
+    if group_stats is not None:
+        group_stats.record_stage(label, seconds)
+
+
+async def _timed_iter(
+    profiler: RunProfiler | None,
+    group_stats: GroupStats | None,
+    label: str,
+    iterator: AsyncIterator[Any],
+) -> AsyncIterator[Any]:
+    while True:
+        start = time.perf_counter()
+        try:
+            item = await iterator.__anext__()
+        except StopAsyncIteration:
+            _record(profiler, group_stats, label, time.perf_counter() - start)
+            return
+        _record(profiler, group_stats, label, time.perf_counter() - start)
+        yield item
+
+
+def _is_profile_id(profile_id: str) -> bool:
+    """Reject ids that could escape the profiles directory."""
+    return (
+        bool(profile_id)
+        and os.path.basename(profile_id) == profile_id
+        and not profile_id.startswith(".")
+    )
+
+
+def list_profiles(profiles_dir: str = "profiles") -> list[dict[str, Any]]:
+    """List saved profile summaries, newest first, without their hotspot lists."""
+    if not os.path.isdir(profiles_dir):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(profiles_dir), reverse=True):
+        if not name.endswith(".json"):
+            continue
+        summary = load_profile_summary(name[: -len(".json")], profiles_dir)
+        if summary is not None:
+            profiles.append(
+                {key: value for key, value in summary.items() if key != "hotspots"}
+            )
+    return profiles
+
+
+def load_profile_summary(
+    profile_id: str, profiles_dir: str = "profiles"
+) -> dict[str, Any] | None:
+    if not _is_profile_id(profile_id):
+        return None
+    path = os.path.join(profiles_dir, f"{profile_id}.json")
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def profile_artifact_path(profile_id: str, profiles_dir: str = "profiles") -> str | None:
+    summary = load_profile_summary(profile_id, profiles_dir)
+    if summary is None:
+        return None
+    path = os.path.join(profiles_dir, summary["artifact"])
+    return path if os.path.isfile(path) else None
@@ -0,0 +1,172 @@
+"""Per-group cost and throughput accounting for ingestion runs.
+
+A ``RunStats`` collector wraps a run; inside ``run_stats.group(group_id)`` all work
+on the current task is charged to that group through a context variable:
+
+- Telegram requests, counted by ``CountingTelegramClient`` (clients created by the
+  pipeline are of that class), so pages fetched by ``iter_messages`` and requests
+  sent through a takeout session count too;
+- flood-wait seconds the pipeline sleeps through after a ``FloodWaitError``
+  (``record_flood_wait``). Short waits Telethon sleeps through by itself, below the
+  client's ``flood_sleep_threshold``, are not visible and not counted;
+- messages fetched, new and duplicate;
+- wall time per stage, under the ``track_await``/``timed_iter`` labels;
+- BigQuery bytes billed by ``check_duplicates`` and ``update_metadata``, from the
+  query job statistics (``record_bytes_billed``).
+
+The collector only keeps rows in memory; the run writes them to the run-stats
+table with one bulk write at the end.
+"""
+
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Iterator
+
+from telethon import TelegramClient, utils
+
+from jobs import current_job
+
+BILLED_QUERIES = ("check_duplicates", "update_metadata")
+
+_current_group: ContextVar["GroupStats | None"] = ContextVar(
+    "current_group_stats", default=None
+)
+
+
+class GroupStats:
+    """Counters for one group in one run."""
+
+    def __init__(self, group_id: str):
+        self.group_id = group_id
+        self.started_at = datetime.now(timezone.utc)
+        self.wall_s = 0.0
+        self.telegram_requests = 0
+        self.flood_wait_s = 0.0
+        self.messages_fetched = 0
+        self.messages_new = 0
+        self.messages_duplicate = 0
+        self.stages: dict[str, dict[str, float]] = {}
+        self.bytes_billed = dict.fromkeys(BILLED_QUERIES, 0)
+        self.error: str | None = None
+
+    def __repr__(self) -> str:
+        return f"GroupStats({self.group_id})"
+
+    def record_stage(self, label: str, seconds: float):
+        stage = self.stages.setdefault(label, {"calls": 0, "seconds": 0.0})
+        stage["calls"] += 1
+        stage["seconds"] += seconds
+
+    def record_messages(self, fetched: int, new: int):
+        self.messages_fetched += fetched
+        self.messages_new += new
+        self.messages_duplicate += fetched - new
+
+    def to_row(self, run_id: str, run_kind: str) -> dict[str, Any]:
+        return {
+            "run_id": run_id,
+            "run_kind": run_kind,
+            "group_id": self.group_id,
+            "started_at": self.started_at.isoformat(),
+            "wall_s": round(self.wall_s, 3),
+            "telegram_requests": self.telegram_requests,
+            "flood_wait_s": round(self.flood_wait_s, 3),
+            "messages_fetched": self.messages_fetched,
+            "messages_new": self.messages_new,
+            "messages_duplicate": self.messages_duplicate,
+            "stages": [
+                {
+                    "stage": label,
+                    "calls": int(stage["calls"]),
+                    "seconds": round(stage["seconds"], 6),
+                }
+                for label, stage in sorted(self.stages.items())
+            ],
+            "check_duplicates_bytes_billed": self.bytes_billed["check_duplicates"],
+            "update_metadata_bytes_billed": self.bytes_billed["update_metadata"],
+            "error": self.error,
+        }
+
+
+class RunStats:
+    """Collects ``GroupStats`` for every group a run touches.
+
+    Inside an API job the run id is the job id, so stats join with /jobs results.
+    """
+
+    def __init__(self, kind: str = "ingest"):
+        job = current_job()
+        self.run_id = job.id if job is not None else uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.groups: dict[str, GroupStats] = {}
+
+    def __repr__(self) -> str:
+        return f"RunStats({self.kind} {self.run_id}, {len(self.groups)} groups)"
+
+    @contextmanager
+    def group(self, group_id: str) -> Iterator[GroupStats]:
+        """Charge the work done on this task inside the block to ``group_id``.
+
+        Entering a group again (e.g. a re-ingest resolving, then fetching it) adds
+        to the same stats.
+        """
+        stats = self.groups.get(group_id)
+        if stats is None:
+            stats = self.groups[group_id] = GroupStats(group_id)
+        token = _current_group.set(stats)
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.wall_s += time.perf_counter() - start
+            _current_group.reset(token)
+
+    def rows(self) -> list[dict[str, Any]]:
+        return [stats.to_row(self.run_id, self.kind) for stats in self.groups.values()]
+
+    def summary(self) -> str:
+        groups = self.groups.values()
+        requests = sum(stats.telegram_requests for stats in groups)
+        flood_wait_s = sum(stats.flood_wait_s for stats in groups)
+        bytes_billed = sum(sum(stats.bytes_billed.values()) for stats in groups)
+        return (
+            f"Run {self.run_id}: {len(self.groups)} groups, {requests} Telegram requests, "
+            f"{flood_wait_s:.0f}s flood wait, {bytes_billed / 1e9:.3f} GB billed"
+        )
+
+
+def current_group_stats() -> GroupStats | None:
+    """Stats of the group the calling task (or ``to_thread`` worker) works on, if any."""
+    return _current_group.get()
+
+
+def record_flood_wait(seconds: float):
+    stats = _current_group.get()
+    if stats is not None:
+        stats.flood_wait_s += seconds
+
+
+def record_bytes_billed(query: str, job):
+    """Add a finished query job's billed bytes to the current group's ``query`` total."""
+    stats = _current_group.get()
+    if stats is not None:
+        stats.bytes_billed[query] += getattr(job, "total_bytes_billed", None) or 0
+
+
+class CountingTelegramClient(TelegramClient):
+    """TelegramClient that charges every request it sends to the current group.
+
+    ``__call__`` is the public entry point every request goes through, including
+    the pages of ``iter_messages`` and requests wrapped by a takeout session.
+    """
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        stats = _current_group.get()
+        if stats is not None:
+            stats.telegram_requests += len(request) if utils.is_list_like(request) else 1
+        return await super().__call__(
+            request, ordered=ordered, flood_sleep_threshold=flood_sleep_threshold
+        )
@@ -0,0 +1,64 @@
+"""Compare peak memory of dict rows vs MessageRow on synthetic messages.
+
+Usage:
+    python scripts/bench_message_rows.py --count 1000000
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from telegram_bq_ingest import normalize_message  # noqa: E402
+
+
+def synthetic_messages(count: int):
+    """Yield Telethon-like messages without keeping them alive."""
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    sender = SimpleNamespace(first_name="user")
+    for i in range(count):
+        text = f"message {i} see https://example.com/p/{i % 1000}" if i % 3 else f"hi @channel_{i % 50:05d}"
+        yield SimpleNamespace(
+            id=i,
+            sender_id=1000 + i % 500,
+            sender=sender,
+            message=text,
+            media=None,
+            date=base + timedelta(seconds=i),
+            views=i % 700,
+            replies=None,
+            forwards=i % 7,
+        )
+
+
+def measure(label: str, count: int, build):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = [build(message) for message in synthetic_messages(count)]
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<12} rows={len(rows):>9,}  peak={peak / 2**20:8.1f} MiB  time={elapsed:6.2f}s")
+    del rows
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    dict_peak = measure("dict", args.count, lambda m: normalize_message(m, "group").to_dict())
+    row_peak = measure("MessageRow", args.count, lambda m: normalize_message(m, "group"))
+    print(f"Peak reduction: {(1 - row_peak / dict_peak) * 100:.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Benchmark near-duplicate detection on a synthetic corpus with planted reposts.
+
+Reports per-message latency (signature + lookup + insert), index size, and
+recall/false-positive rate against the planted reposts.
+
+Usage:
+    python scripts/bench_near_dup.py --count 1000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from near_dup import NearDupIndex  # noqa: E402
+
+VOCABULARY = [f"w{i}" for i in range(20_000)]
+
+
+def make_text(rng: random.Random) -> str:
+    return " ".join(rng.choices(VOCABULARY, k=rng.randint(12, 60)))
+
+
+def mutate(text: str, rng: random.Random) -> str:
+    """A repost: same text with one word replaced, appended or dropped."""
+    words = text.split()
+    edit = rng.randrange(3)
+    if edit == 0:
+        words[rng.randrange(len(words))] = rng.choice(VOCABULARY)
+    elif edit == 1:
+        words.append(rng.choice(VOCABULARY))
+    else:
+        del words[rng.randrange(len(words))]
+    return " ".join(words)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=1_000_000)
+    parser.add_argument("--repost-rate", type=float, default=0.1)
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--window-days", type=float, default=7)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    index = NearDupIndex(args.threshold, args.window_days)
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    # One message every ~2 seconds: 1M messages span about 3 weeks
+    step = timedelta(seconds=2)
+    recent_originals: list[str] = []
+
+    planted = found = false_positives = 0
+    latencies = []
+    start = time.perf_counter()
+    for i in range(args.count):
+        is_repost = bool(recent_originals) and rng.random() < args.repost_rate
+        if is_repost:
+            text = mutate(rng.choice(recent_originals), rng)
+        else:
+            text = make_text(rng)
+            recent_originals.append(text)
+            if len(recent_originals) > 1000:
+                recent_originals.pop(0)
+
+        t0 = time.perf_counter()
+        signature = index.signature(text)
+        original = index.check(signature, f"g/{i}", base + i * step)
+        latencies.append(time.perf_counter() - t0)
+
+        if is_repost:
+            planted += 1
+            found += original is not None
+        elif original is not None:
+            false_positives += 1
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    originals = args.count - planted
+    print(f"messages={args.count:,}  index size={len(index):,}  wall={elapsed:.1f}s")
+    print(
+        f"latency per message: mean={sum(latencies) / len(latencies) * 1e6:.1f}us  "
+        f"p50={latencies[len(latencies) // 2] * 1e6:.1f}us  "
+        f"p99={latencies[int(len(latencies) * 0.99)] * 1e6:.1f}us"
+    )
+    print(f"recall={found / max(planted, 1):.3f} ({found:,}/{planted:,} planted reposts)")
+    print(f"false positives={false_positives / max(originals, 1):.5f} ({false_positives:,})")
+
+
+if __name__ == "__main__":
+    main()
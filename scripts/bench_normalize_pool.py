@@ -0,0 +1,84 @@
+"""Measure normalization throughput inline vs. NormalizationPool with 1..N workers.
+
+Usage:
+    python scripts/bench_normalize_pool.py --count 200000 --batch-size 1000
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from telegram_bq_ingest import NormalizationPool, collect_messages  # noqa: E402
+
+
+def synthetic_corpus(count: int) -> list[SimpleNamespace]:
+    """Telethon-like messages with link-heavy text, so regex work dominates."""
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    sender = SimpleNamespace(first_name="user")
+    words = " ".join(f"word{i}" for i in range(40))
+    return [
+        SimpleNamespace(
+            id=i,
+            sender_id=1000 + i % 500,
+            sender=sender,
+            message=(
+                f"{words} https://example.com/a/{i} and http://news.example.org/{i % 97}?q=1 "
+                f"join https://t.me/channel_{i % 50:05d} {words}"
+            ),
+            media=None,
+            date=base + timedelta(seconds=i),
+            views=i % 700,
+            replies=None,
+            forwards=i % 7,
+        )
+        for i in range(count)
+    ]
+
+
+async def _stream(corpus):
+    for message in corpus:
+        yield message
+
+
+async def run(corpus, workers: int, batch_size: int) -> float:
+    pool = NormalizationPool(workers, batch_size) if workers else None
+    try:
+        if pool is not None:
+            # Warm up worker processes so spawn time is not measured
+            await collect_messages(_stream(corpus[: batch_size * workers]), "group", pool)
+        start = time.perf_counter()
+        rows = await collect_messages(_stream(corpus), "group", pool)
+        elapsed = time.perf_counter() - start
+    finally:
+        if pool is not None:
+            await pool.close()
+    assert len(rows) == len(corpus)
+    return len(corpus) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=200_000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    corpus = synthetic_corpus(args.count)
+    print(f"{args.count:,} messages, batch size {args.batch_size}, {os.cpu_count()} CPUs")
+    baseline = asyncio.run(run(corpus, 0, args.batch_size))
+    print(f"inline      {baseline:>10,.0f} msg/s")
+    workers = 1
+    while workers <= args.max_workers:
+        throughput = asyncio.run(run(corpus, workers, args.batch_size))
+        print(f"workers={workers:<3} {throughput:>10,.0f} msg/s  ({throughput / baseline:.2f}x)")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Check history_export_client against a fake client that grants or refuses takeout.
+
+Covers a granted takeout, a refused one (TakeoutInitDelayError) and a session that
+still holds the takeout id of a run that died before finishing it. No network.
+
+Usage:
+    python scripts/check_takeout_fallback.py
+"""
+
+import asyncio
+import os
+import sys
+
+from telethon import TelegramClient
+from telethon.errors import RPCError, TakeoutInitDelayError
+from telethon.sessions import MemorySession
+from telethon.tl.functions import InvokeWithTakeoutRequest
+from telethon.tl.functions.account import (
+    FinishTakeoutSessionRequest,
+    InitTakeoutSessionRequest,
+)
+from telethon.tl.types.account import Takeout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from telegram_bq_ingest import history_export_client  # noqa: E402
+
+
+class FakeTakeoutClient(TelegramClient):
+    """Answers only the takeout requests; everything else is a bug in the check."""
+
+    def __init__(
+        self, grant: bool, stale_takeout_id: int | None = None, stale_known: bool = True
+    ):
+        super().__init__(MemorySession(), 1, "api-hash")
+        self.grant = grant
+        self.stale_known = stale_known
+        self.session.takeout_id = stale_takeout_id
+        self.requests: list[tuple[str, object]] = []
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        if isinstance(request, InvokeWithTakeoutRequest):
+            request = request.query
+        if isinstance(request, InitTakeoutSessionRequest):
+            self.requests.append(("init", None))
+            if not self.grant:
+                raise TakeoutInitDelayError(request=request, capture=3600)
+            return Takeout(id=42)
+        if isinstance(request, FinishTakeoutSessionRequest):
+            self.requests.append(("finish", request.success))
+            if self.session.takeout_id != 42 and not self.stale_known:
+                raise RPCError(request, "TAKEOUT_INVALID", 400)
+            return True
+        raise AssertionError(f"Unexpected request {request!r}")
+
+
+async def run_case(client: FakeTakeoutClient) -> bool:
+    """Enter and leave history_export_client; returns whether takeout was used."""
+    async with history_export_client(client, use_takeout=True) as history_client:
+        used_takeout = history_client is not client
+    assert client.session.takeout_id is None, "takeout id left in the session"
+    return used_takeout
+
+
+async def main():
+    granted = FakeTakeoutClient(grant=True)
+    assert await run_case(granted)
+    assert granted.requests == [("init", None), ("finish", True)], granted.requests
+    print("granted: takeout used and finished")
+
+    refused = FakeTakeoutClient(grant=False)
+    assert not await run_case(refused)
+    assert refused.requests == [("init", None)], refused.requests
+    print("refused: regular client used")
+
+    stale = FakeTakeoutClient(grant=True, stale_takeout_id=7)
+    assert await run_case(stale)
+    # Telethon's end_takeout does not pass its success flag on, only check the order
+    assert [kind for kind, _ in stale.requests] == ["finish", "init", "finish"], stale.requests
+    print("stale takeout: finished, then a new takeout used")
+
+    invalid = FakeTakeoutClient(grant=True, stale_takeout_id=7, stale_known=False)
+    assert await run_case(invalid)
+    assert [kind for kind, _ in invalid.requests] == ["finish", "init", "finish"], invalid.requests
+    print("stale takeout the server no longer knows: discarded, then a new takeout used")
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,15 +1,44 @@
 import asyncio
+import multiprocessing
 import os
 import re
-from datetime import datetime, timezone
-from typing import Any, Awaitable, Callable
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Awaitable, Callable
 
 from dotenv import load_dotenv
 from google.api_core.exceptions import NotFound
 from google.cloud import bigquery
-from telethon import TelegramClient
-from telethon.errors import FloodWaitError, RPCError
-from telethon.tl.types import Channel, Chat, MessageMediaDocument, MessageMediaPhoto
+from telethon import TelegramClient, utils
+from telethon.errors import FloodWaitError, RPCError, TakeoutInitDelayError
+from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.tl.functions.updates import GetChannelDifferenceRequest
+from telethon.tl.types import (
+    Channel,
+    ChannelMessagesFilterEmpty,
+    Chat,
+    InputPeerChannel,
+    Message,
+    MessageMediaDocument,
+    MessageMediaPhoto,
+    UpdateDeleteChannelMessages,
+    UpdateEditChannelMessage,
+)
+from telethon.tl.types.updates import ChannelDifferenceEmpty, ChannelDifferenceTooLong
+
+from bq_utils import get_entities_data_from_bq
+from jobs import claim_group, current_job
+from media import MediaDownloader, media_info
+from near_dup import NearDupIndex
+from profiling import timed_iter, track_await
+from run_stats import (
+    CountingTelegramClient,
+    RunStats,
+    current_group_stats,
+    record_bytes_billed,
+    record_flood_wait,
+)
 
 
 async def retry_on_flood(
@@ -20,6 +49,7 @@ async def retry_on_flood(
             return await func(*args, **kwargs)
         except FloodWaitError as e:
             print(f"Waiting {e.seconds} seconds...")
+            record_flood_wait(e.seconds)
             await asyncio.sleep(e.seconds)
 
 
@@ -46,6 +76,7 @@ async def is_eligible_for_scraping(
         return False
     except FloodWaitError as e:
         print(f"⏳ Flood wait error: {e}")
+        record_flood_wait(e.seconds)
         await asyncio.sleep(e.seconds)
         await retry_on_flood(
             func=is_eligible_for_scraping, client=client, entity_id=entity_id
@@ -61,26 +92,36 @@ async def is_eligible_for_scraping(
 def ensure_bq_table(client, project, dataset, table, schema):
     table_id = f"{project}.{dataset}.{table}"
     try:
-        client.get_table(table_id)
+        table_obj = client.get_table(table_id)
     except NotFound:
         table_obj = bigquery.Table(table_id, schema=schema)
         client.create_table(table_obj)
         print(f"Created table {table_id}")
+        return
+
+    # Add columns introduced after the table was created (always NULLABLE)
+    existing_fields = {field.name for field in table_obj.schema}
+    missing_fields = [field for field in schema if field.name not in existing_fields]
+    if missing_fields:
+        table_obj.schema = list(table_obj.schema) + missing_fields
+        client.update_table(table_obj, ["schema"])
+        print(
+            f"Added columns {', '.join(field.name for field in missing_fields)} to {table_id}"
+        )
+
+
+METADATA_SCHEMA = [
+    bigquery.SchemaField("group_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("last_fetch_time", "TIMESTAMP", mode="REQUIRED"),
+    bigquery.SchemaField("is_first_time", "BOOLEAN", mode="REQUIRED"),
+    bigquery.SchemaField("last_message_id", "INTEGER"),
+    # Channel update state for SYNC_MODE=difference
+    bigquery.SchemaField("pts", "INTEGER"),
+]
 
 
 def ensure_metadata_table(client, project, dataset, table):
-    table_id = f"{project}.{dataset}.{table}"
-    schema = [
-        bigquery.SchemaField("group_id", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("last_fetch_time", "TIMESTAMP", mode="REQUIRED"),
-        bigquery.SchemaField("is_first_time", "BOOLEAN", mode="REQUIRED"),
-    ]
-    try:
-        client.get_table(table_id)
-    except NotFound:
-        table_obj = bigquery.Table(table_id, schema=schema)
-        client.create_table(table_obj)
-        print(f"Created metadata table {table_id}")
+    ensure_bq_table(client, project, dataset, table, METADATA_SCHEMA)
 
 
 def extract_urls(text):
@@ -127,44 +168,337 @@ def get_message_type(message):
     return "text"
 
 
-def normalize_message(message, group_id):
-    """Normalize Telegram message to BigQuery schema."""
-    return {
-        "message_id": str(message.id),
-        "group_id": str(group_id),
-        "sender_id": str(message.sender_id) if message.sender_id else None,
-        "sender_name": getattr(message.sender, "first_name", None)
-        if hasattr(message, "sender")
-        else None,
-        "message_text": message.message,
-        "message_type": get_message_type(message),
-        "timestamp": message.date.isoformat(),
-        "insert_date": datetime.now(timezone.utc).isoformat(),
-        "source": "telegram",
-        "links": extract_urls(message.message),
-        "telegram_url": extract_telegram_url(message.message),
-        "views": getattr(message, "views", None),
-        "replies": getattr(message, "replies", None).replies
-        if getattr(message, "replies", None)
-        else None,
-        "forwards": getattr(message, "forwards", None),
-    }
+class MessageRow:
+    """Compact normalized message.
+
+    Timestamps stay as datetimes and ids stay raw until ``to_dict`` is called,
+    which should only happen for rows that are actually written.
+    """
+
+    __slots__ = (
+        "message_id",
+        "group_id",
+        "sender_id",
+        "sender_name",
+        "message_text",
+        "message_type",
+        "timestamp",
+        "insert_date",
+        "links",
+        "telegram_url",
+        "views",
+        "replies",
+        "forwards",
+        "content_hash",
+        "near_dup_of",
+        "media_id",
+        "media_size",
+        "media_mime_type",
+        "media_url",
+    )
+
+    source = "telegram"
+
+    def __init__(
+        self,
+        message_id: int,
+        group_id: str,
+        sender_id: int | None,
+        sender_name: str | None,
+        message_text: str | None,
+        message_type: str,
+        timestamp: datetime,
+        insert_date: datetime,
+        links: tuple[str, ...],
+        telegram_url: str | None,
+        views: int | None,
+        replies: int | None,
+        forwards: int | None,
+        content_hash: str | None = None,
+        near_dup_of: str | None = None,
+        media_id: str | None = None,
+        media_size: int | None = None,
+        media_mime_type: str | None = None,
+        media_url: str | None = None,
+    ):
+        self.message_id = message_id
+        self.group_id = group_id
+        self.sender_id = sender_id
+        self.sender_name = sender_name
+        self.message_text = message_text
+        self.message_type = message_type
+        self.timestamp = timestamp
+        self.insert_date = insert_date
+        self.links = links
+        self.telegram_url = telegram_url
+        self.views = views
+        self.replies = replies
+        self.forwards = forwards
+        self.content_hash = content_hash
+        self.near_dup_of = near_dup_of
+        self.media_id = media_id
+        self.media_size = media_size
+        self.media_mime_type = media_mime_type
+        self.media_url = media_url
+
+    @property
+    def key(self) -> tuple[str, str]:
+        """(message_id, group_id) as stored in BigQuery."""
+        return str(self.message_id), self.group_id
+
+    def to_dict(self) -> dict[str, str | int | list[str] | None]:
+        """Serialize to a BigQuery JSON row."""
+        return {
+            "message_id": str(self.message_id),
+            "group_id": self.group_id,
+            "sender_id": str(self.sender_id) if self.sender_id else None,
+            "sender_name": self.sender_name,
+            "message_text": self.message_text,
+            "message_type": self.message_type,
+            "timestamp": self.timestamp.isoformat(),
+            "insert_date": self.insert_date.isoformat(),
+            "source": self.source,
+            "links": list(self.links),
+            "telegram_url": self.telegram_url,
+            "views": self.views,
+            "replies": self.replies,
+            "forwards": self.forwards,
+            "content_hash": self.content_hash,
+            "near_dup_of": self.near_dup_of,
+            "media_id": self.media_id,
+            "media_size": self.media_size,
+            "media_mime_type": self.media_mime_type,
+            "media_url": self.media_url,
+        }
+
+    def __repr__(self) -> str:
+        return f"MessageRow(group_id={self.group_id!r}, message_id={self.message_id!r})"
+
+
+def message_fields(message, sender: Any = None) -> tuple:
+    """Copy the fields normalization needs out of a Telethon message.
+
+    Only cheap attribute reads happen here; the result is picklable so the
+    CPU-heavy part (``normalize_fields``) can run in another process. ``sender``
+    stands in for ``message.sender`` on raw messages that have none attached.
+    """
+    if sender is None:
+        sender = getattr(message, "sender", None)
+    replies = getattr(message, "replies", None)
+    return (
+        message.id,
+        message.sender_id,
+        getattr(sender, "first_name", None),
+        message.message,
+        get_message_type(message),
+        message.date,
+        getattr(message, "views", None),
+        replies.replies if replies else None,
+        getattr(message, "forwards", None),
+        *media_info(message),
+    )
+
+
+def normalize_fields(fields: tuple, group_id: str, insert_date: datetime) -> MessageRow:
+    """Build a MessageRow from ``message_fields`` output, extracting links from the text."""
+    (
+        message_id,
+        sender_id,
+        sender_name,
+        message_text,
+        message_type,
+        timestamp,
+        views,
+        replies,
+        forwards,
+        media_id,
+        media_size,
+        media_mime_type,
+    ) = fields
+    return MessageRow(
+        message_id=message_id,
+        group_id=group_id,
+        sender_id=sender_id,
+        sender_name=sender_name,
+        message_text=message_text,
+        message_type=message_type,
+        timestamp=timestamp,
+        insert_date=insert_date,
+        links=tuple(extract_urls(message_text)),
+        telegram_url=extract_telegram_url(message_text),
+        views=views,
+        replies=replies,
+        forwards=forwards,
+        media_id=media_id,
+        media_size=media_size,
+        media_mime_type=media_mime_type,
+    )
+
+
+def normalize_message(message, group_id, sender: Any = None) -> MessageRow:
+    """Normalize Telegram message to a compact BigQuery row."""
+    return normalize_fields(
+        message_fields(message, sender), str(group_id), datetime.now(timezone.utc)
+    )
+
+
+def _normalize_batch(
+    batch: list[tuple], group_id: str, insert_date: datetime
+) -> list[MessageRow]:
+    """Process pool entry point: normalize one batch of ``message_fields`` tuples."""
+    return [normalize_fields(fields, group_id, insert_date) for fields in batch]
+
+
+class NormalizationPool:
+    """Normalizes messages in worker processes while the event loop keeps fetching.
+
+    Messages are shipped in batches of ``batch_size``; at most two batches per
+    worker are in flight, so memory stays bounded when Telegram is faster than
+    normalization. Results are returned in fetch order.
+
+    Workers are started from a forkserver (spawn where that is unavailable), never
+    forked from the service process, whose event loop and client threads a fork
+    would copy. Create one pool per process and share it between runs.
+    """
+
+    def __init__(self, workers: int, batch_size: int = 1000):
+        self.workers = workers
+        self.batch_size = batch_size
+        start_method = (
+            "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        )
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context(start_method)
+        )
+
+    def __repr__(self) -> str:
+        return f"NormalizationPool(workers={self.workers}, batch_size={self.batch_size})"
+
+    async def normalize(
+        self, messages: AsyncIterator[Any], group_id: str
+    ) -> list[MessageRow]:
+        loop = asyncio.get_running_loop()
+        max_pending = self.workers * 2
+        pending: list[asyncio.Future] = []
+        rows: list[MessageRow] = []
+        batch: list[tuple] = []
+
+        def submit(batch: list[tuple]):
+            pending.append(
+                loop.run_in_executor(
+                    self.executor,
+                    _normalize_batch,
+                    batch,
+                    group_id,
+                    datetime.now(timezone.utc),
+                )
+            )
+
+        async for message in messages:
+            batch.append(message_fields(message))
+            if len(batch) >= self.batch_size:
+                submit(batch)
+                batch = []
+                if len(pending) >= max_pending:
+                    rows.extend(await pending.pop(0))
+        if batch:
+            submit(batch)
+        for future in pending:
+            rows.extend(await future)
+        return rows
+
+    async def close(self):
+        """Wait for the workers to exit without blocking the event loop."""
+        await asyncio.to_thread(self.executor.shutdown)
+
+
+async def collect_messages(
+    messages: AsyncIterator[Any],
+    group_id: str,
+    normalization_pool: NormalizationPool | None = None,
+) -> list[MessageRow]:
+    """Normalize a stream of Telethon messages, inline or through a process pool."""
+    if normalization_pool is not None:
+        return await normalization_pool.normalize(messages, group_id)
+    return [normalize_message(message, group_id) async for message in messages]
 
 
 def initTelegramClient(telegram_config, session_name):
     api_id = int(telegram_config["TELEGRAM_API_ID"])
     api_hash = telegram_config["TELEGRAM_API_HASH"]
-    telegramClient = TelegramClient(session_name, api_id, api_hash)
+    telegramClient = CountingTelegramClient(session_name, api_id, api_hash)
     return telegramClient
 
 
+async def connect_telegram_client(
+    telegram_config: dict[str, str | None], session_name: str = "fetch_session"
+) -> TelegramClient:
+    """Create and connect a Telegram client that can be kept open across runs.
+
+    Unlike ``client.start()`` this never prompts for a phone number, so it is
+    safe to call from a server process: an unauthorized session raises instead.
+    """
+    client = initTelegramClient(telegram_config, session_name)
+    bot_token = telegram_config.get("TELEGRAM_BOT_TOKEN")
+    if bot_token:
+        await client.start(bot_token=bot_token)
+        return client
+
+    await client.connect()
+    if not await client.is_user_authorized():
+        await client.disconnect()
+        raise RuntimeError(
+            f"Telegram session '{session_name}' is not authorized, run auth_telegram.py first"
+        )
+    return client
+
+
+@asynccontextmanager
+async def history_export_client(
+    client: TelegramClient, use_takeout: bool = False
+) -> AsyncIterator[TelegramClient]:
+    """Yield a client to read history with, preferring a takeout session.
+
+    Telegram applies much lower flood limits to takeout sessions, which makes them
+    the right tool for large backfills. When takeout is not requested, or the
+    account refuses it (e.g. it must first be confirmed from another device), the
+    regular client is yielded instead. The takeout session is finished on exit.
+    A takeout left open by a run that died before finishing it is finished first,
+    since Telethon refuses to start a new one while the session still holds its id.
+    """
+    async with AsyncExitStack() as stack:
+        history_client = client
+        if use_takeout:
+            if client.session.takeout_id is not None:
+                print("⚠ Finishing a takeout session left open by an earlier run")
+                try:
+                    await client.end_takeout(success=False)
+                except RPCError as e:
+                    print(f"⚠ Could not finish the stale takeout ({e}), discarding it")
+                client.session.takeout_id = None
+            try:
+                history_client = await stack.enter_async_context(
+                    client.takeout(
+                        finalize=True, chats=True, megagroups=True, channels=True
+                    )
+                )
+                print("📦 Using takeout session for history export")
+            except TakeoutInitDelayError as e:
+                print(
+                    f"⚠ Takeout not granted yet (retry in {e.seconds} seconds), using the regular client"
+                )
+            except (RPCError, ValueError) as e:
+                print(f"⚠ Takeout unavailable ({e}), using the regular client")
+        yield history_client
+
+
 async def fetch_messages_async(
     group_id: str,
     last_ts: str | None,
     from_date: str | None,
     to_date: str | None,
     telegram_config: dict[str, str] | None = None,
-) -> list[dict[str, str | int | list[str] | None]]:
+) -> list[MessageRow]:
     """Fetch messages from Telegram group within date range or since last timestamp."""
     if telegram_config is None:
         raise ValueError("telegram_config is required")
@@ -194,12 +528,7 @@ async def fetch_messages_async(
 
     messages = []
     try:
-        async for message in client.iter_messages(
-            entity=group_id, offset_date=offset_date, reverse=True
-        ):
-            # Filter by to_date if provided
-            if to_date and message.date > datetime.fromisoformat(to_date):
-                continue
+        async for message in _iter_history(client, group_id, offset_date, to_date):
             messages.append(normalize_message(message, group_id))
     except FloodWaitError as e:
         print(f"⏳ Flood wait error while fetching messages: {e}")
@@ -242,30 +571,27 @@ def check_duplicates(client, project, dataset, table, messages):
     if not messages:
         return []
     table_id = f"{project}.{dataset}.{table}"
-    message_ids = [msg["message_id"] for msg in messages]
-    group_ids = [msg["group_id"] for msg in messages]
-    placeholders = ", ".join(
-        [f"(@msg_id_{i}, @group_id_{i})" for i in range(len(messages))]
-    )
+    keys = [msg.key for msg in messages]
+    # Two array parameters instead of two scalars per message; the exact
+    # (message_id, group_id) pairs are matched below.
     query = f"""
         SELECT message_id, group_id FROM `{table_id}`
-        WHERE (message_id, group_id) IN ({placeholders})
-    """
-    query_params = []
-    for i, (msg_id, group_id) in enumerate(zip(message_ids, group_ids)):
-        query_params.extend(
-            [
-                bigquery.ScalarQueryParameter(f"msg_id_{i}", "STRING", msg_id),
-                bigquery.ScalarQueryParameter(f"group_id_{i}", "STRING", group_id),
-            ]
-        )
+        WHERE group_id IN UNNEST(@group_ids) AND message_id IN UNNEST(@message_ids)
+    """
+    query_params = [
+        bigquery.ArrayQueryParameter(
+            "group_ids", "STRING", sorted({group_id for _, group_id in keys})
+        ),
+        bigquery.ArrayQueryParameter(
+            "message_ids", "STRING", [message_id for message_id, _ in keys]
+        ),
+    ]
     job = client.query(
         query, job_config=bigquery.QueryJobConfig(query_parameters=query_params)
     )
     existing = {(row["message_id"], row["group_id"]) for row in job}
-    return [
-        msg for msg in messages if (msg["message_id"], msg["group_id"]) not in existing
-    ]
+    record_bytes_billed("check_duplicates", job)
+    return [msg for msg, key in zip(messages, keys) if key not in existing]
 
 
 def update_metadata(
@@ -274,69 +600,81 @@ def update_metadata(
     dataset: str,
     metadata_table: str,
     group_id: str,
-    messages: list[dict[str, str | int | list[str] | None]],
+    messages: list[MessageRow],
 ):
-    """Update last fetch time for a group."""
+    """Advance a group's cursor (last fetch time and message id)."""
     if not messages:
         print(f"No new messages to update for {group_id}")
         return
 
-    last_ts = max(m["timestamp"] for m in messages)
+    last_ts_dt = max(m.timestamp for m in messages)
+    last_message_id = max(int(m.message_id) for m in messages)
     table_id = f"{project}.{dataset}.{metadata_table}"
 
-    # Check if this is the first time for this group
-    check_query = f"""
-    SELECT COUNT(*) as count
-    FROM `{table_id}`
-    WHERE group_id = @group_id
+    # After the first run is_first_time is always false. GREATEST keeps the cursor
+    # from moving backwards when an older window is re-ingested.
+    # Use MERGE instead of DELETE + INSERT to avoid streaming buffer issues
+    merge_query = f"""
+    MERGE `{table_id}` AS target
+    USING (SELECT @group_id as group_id, @last_fetch_time as last_fetch_time, @last_message_id as last_message_id) AS source
+    ON target.group_id = source.group_id
+    WHEN MATCHED THEN
+      UPDATE SET
+        last_fetch_time = GREATEST(target.last_fetch_time, source.last_fetch_time),
+        last_message_id = GREATEST(IFNULL(target.last_message_id, 0), source.last_message_id),
+        is_first_time = FALSE
+    WHEN NOT MATCHED THEN
+      INSERT (group_id, last_fetch_time, last_message_id, is_first_time)
+      VALUES (source.group_id, source.last_fetch_time, source.last_message_id, FALSE)
     """
 
     job_config = bigquery.QueryJobConfig(
         query_parameters=[
-            bigquery.ScalarQueryParameter("group_id", "STRING", str(group_id))
+            bigquery.ScalarQueryParameter("group_id", "STRING", str(group_id)),
+            bigquery.ScalarQueryParameter("last_fetch_time", "TIMESTAMP", last_ts_dt),
+            bigquery.ScalarQueryParameter("last_message_id", "INT64", last_message_id),
         ]
     )
 
     try:
-        result = client.query(check_query, job_config=job_config).result()
-        row = list(result)[0]
-        is_first_time = row.count == 0
+        job = client.query(merge_query, job_config=job_config)
+        job.result()
+        record_bytes_billed("update_metadata", job)
+        print(
+            f"Updated metadata for {group_id} to {last_ts_dt.isoformat()} (message {last_message_id})"
+        )
     except Exception as e:
-        print(f"Warning: Could not check if first time for {group_id}: {e}")
-        is_first_time = True
+        raise Exception(f"Metadata update errors: {e}")
 
-    # After first run, always set is_first_time to false
-    is_first_time = False
 
-    # Use MERGE instead of DELETE + INSERT to avoid streaming buffer issues
+def update_sync_state(
+    client: bigquery.Client,
+    project: str,
+    dataset: str,
+    metadata_table: str,
+    group_id: str,
+    pts: int,
+):
+    """Store the channel update state (pts) the next difference sync starts from."""
+    table_id = f"{project}.{dataset}.{metadata_table}"
     merge_query = f"""
     MERGE `{table_id}` AS target
-    USING (SELECT @group_id as group_id, @last_fetch_time as last_fetch_time, @is_first_time as is_first_time) AS source
+    USING (SELECT @group_id as group_id, @pts as pts) AS source
     ON target.group_id = source.group_id
     WHEN MATCHED THEN
-      UPDATE SET last_fetch_time = source.last_fetch_time, is_first_time = source.is_first_time
+      UPDATE SET pts = source.pts
     WHEN NOT MATCHED THEN
-      INSERT (group_id, last_fetch_time, is_first_time) VALUES (source.group_id, source.last_fetch_time, source.is_first_time)
+      INSERT (group_id, last_fetch_time, is_first_time, pts)
+      VALUES (source.group_id, CURRENT_TIMESTAMP(), FALSE, source.pts)
     """
-
-    # Convert last_ts string to datetime object for BigQuery
-    last_ts_dt = datetime.fromisoformat(last_ts)
-
     job_config = bigquery.QueryJobConfig(
         query_parameters=[
             bigquery.ScalarQueryParameter("group_id", "STRING", str(group_id)),
-            bigquery.ScalarQueryParameter("last_fetch_time", "TIMESTAMP", last_ts_dt),
-            bigquery.ScalarQueryParameter("is_first_time", "BOOL", is_first_time),
+            bigquery.ScalarQueryParameter("pts", "INT64", pts),
         ]
     )
-
-    try:
-        client.query(merge_query, job_config=job_config).result()
-        print(
-            f"Updated metadata for {group_id} to {last_ts}, is_first_time: {is_first_time}"
-        )
-    except Exception as e:
-        raise Exception(f"Metadata update errors: {e}")
+    client.query(merge_query, job_config=job_config).result()
+    print(f"Updated sync state for {group_id} to pts {pts}")
 
 
 def format_telegram_url(url: str | None) -> str | None:
@@ -503,7 +841,7 @@ async def update_metadata_from_telegram_urls(
 
 
 def handle_new_messages(
-    messages: list[dict[str, str | int | list[str] | None]],
+    messages: list[MessageRow],
     entity_id: str,
     bg_client: bigquery.Client,
     bq_project: str,
@@ -517,7 +855,9 @@ def handle_new_messages(
     print(f"Found {len(new_messages)} new messages (after duplicate check)")
     if new_messages:
         table_id = f"{bq_project}.{bq_dataset}.{bq_table}"
-        errors = bg_client.insert_rows_json(table_id, new_messages)
+        errors = bg_client.insert_rows_json(
+            table_id, [msg.to_dict() for msg in new_messages]
+        )
         if errors:
             raise Exception(f"BigQuery insert errors: {errors}")
         print(f"✅ Inserted {len(new_messages)} messages for {entity_id}")
@@ -526,140 +866,1221 @@ def handle_new_messages(
     return 0
 
 
+def record_message_changes(
+    client: bigquery.Client,
+    project: str,
+    dataset: str,
+    table: str,
+    changes: list[dict[str, str | int | list[str] | None]],
+):
+    """Append edit and delete (tombstone) rows for already ingested messages."""
+    if not changes:
+        return
+    table_id = f"{project}.{dataset}.{table}"
+    errors = client.insert_rows_json(table_id, changes)
+    if errors:
+        raise Exception(f"BigQuery insert errors: {errors}")
+    print(f"✅ Recorded {len(changes)} message changes in {table_id}")
+
+
+MESSAGES_SCHEMA = [
+    bigquery.SchemaField("message_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("group_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("sender_id", "STRING"),
+    bigquery.SchemaField("sender_name", "STRING"),
+    bigquery.SchemaField("message_text", "STRING"),
+    bigquery.SchemaField("message_type", "STRING"),
+    bigquery.SchemaField("timestamp", "TIMESTAMP"),
+    bigquery.SchemaField("insert_date", "TIMESTAMP"),
+    bigquery.SchemaField("source", "STRING"),
+    bigquery.SchemaField("links", "STRING", mode="REPEATED"),
+    bigquery.SchemaField("telegram_url", "STRING"),
+    bigquery.SchemaField("views", "INTEGER"),
+    bigquery.SchemaField("replies", "INTEGER"),
+    bigquery.SchemaField("forwards", "INTEGER"),
+    bigquery.SchemaField("content_hash", "STRING"),
+    bigquery.SchemaField("near_dup_of", "STRING"),
+    bigquery.SchemaField("media_id", "STRING"),
+    bigquery.SchemaField("media_size", "INTEGER"),
+    bigquery.SchemaField("media_mime_type", "STRING"),
+    bigquery.SchemaField("media_url", "STRING"),
+]
+
+# Edits and deletions seen by difference sync. Rows are only appended: the
+# current state of a message is its latest change (a "delete" is a tombstone).
+CHANGES_SCHEMA = [
+    bigquery.SchemaField("message_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("group_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("change_type", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("message_text", "STRING"),
+    bigquery.SchemaField("links", "STRING", mode="REPEATED"),
+    bigquery.SchemaField("edit_date", "TIMESTAMP"),
+    bigquery.SchemaField("pts", "INTEGER"),
+    bigquery.SchemaField("recorded_at", "TIMESTAMP", mode="REQUIRED"),
+]
+
+# One row per file stored by the media downloader (see media.py). Failed downloads
+# get a row with ``error`` set: message rows with that media_url have no file yet.
+MEDIA_SCHEMA = [
+    bigquery.SchemaField("media_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("media_url", "STRING"),
+    bigquery.SchemaField("mime_type", "STRING"),
+    bigquery.SchemaField("size", "INTEGER"),
+    bigquery.SchemaField("sha256", "STRING"),
+    bigquery.SchemaField("stored_at", "TIMESTAMP"),
+    bigquery.SchemaField("error", "STRING"),
+]
+
+# One row per group per run, written in bulk at the end of the run (see run_stats.py)
+RUN_STATS_SCHEMA = [
+    bigquery.SchemaField("run_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("run_kind", "STRING"),
+    bigquery.SchemaField("group_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("started_at", "TIMESTAMP", mode="REQUIRED"),
+    bigquery.SchemaField("wall_s", "FLOAT"),
+    bigquery.SchemaField("telegram_requests", "INTEGER"),
+    bigquery.SchemaField("flood_wait_s", "FLOAT"),
+    bigquery.SchemaField("messages_fetched", "INTEGER"),
+    bigquery.SchemaField("messages_new", "INTEGER"),
+    bigquery.SchemaField("messages_duplicate", "INTEGER"),
+    bigquery.SchemaField(
+        "stages",
+        "RECORD",
+        mode="REPEATED",
+        fields=[
+            bigquery.SchemaField("stage", "STRING"),
+            bigquery.SchemaField("calls", "INTEGER"),
+            bigquery.SchemaField("seconds", "FLOAT"),
+        ],
+    ),
+    bigquery.SchemaField("check_duplicates_bytes_billed", "INTEGER"),
+    bigquery.SchemaField("update_metadata_bytes_billed", "INTEGER"),
+    bigquery.SchemaField("error", "STRING"),
+]
+
+ENGAGEMENT_SCHEMA = [
+    bigquery.SchemaField("message_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("group_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("views", "INTEGER"),
+    bigquery.SchemaField("replies", "INTEGER"),
+    bigquery.SchemaField("forwards", "INTEGER"),
+    bigquery.SchemaField("snapshot_time", "TIMESTAMP", mode="REQUIRED"),
+]
+
+# channels.getMessages accepts at most 100 ids per request
+ENGAGEMENT_BATCH_SIZE = 100
+
+
+def get_recent_message_ids(
+    client: bigquery.Client,
+    project: str,
+    dataset: str,
+    table: str,
+    days: int,
+) -> dict[str, list[int]]:
+    """Get ids of messages posted in the last ``days`` days, grouped by group_id."""
+    table_id = f"{project}.{dataset}.{table}"
+    query = f"""
+        SELECT DISTINCT group_id, message_id FROM `{table_id}`
+        WHERE timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @days DAY)
+    """
+    job = client.query(
+        query,
+        job_config=bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter("days", "INT64", days)]
+        ),
+    )
+    ids_by_group: dict[str, list[int]] = {}
+    for row in job:
+        ids_by_group.setdefault(row["group_id"], []).append(int(row["message_id"]))
+    return ids_by_group
+
+
+def load_engagement_snapshots(
+    client: bigquery.Client,
+    project: str,
+    dataset: str,
+    table: str,
+    snapshots: list[dict[str, str | int | None]],
+):
+    """Append engagement snapshot rows with a single load job."""
+    if not snapshots:
+        print("No engagement snapshots to load")
+        return
+    table_id = f"{project}.{dataset}.{table}"
+    job_config = bigquery.LoadJobConfig(
+        schema=ENGAGEMENT_SCHEMA,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+    )
+    client.load_table_from_json(snapshots, table_id, job_config=job_config).result()
+    print(f"✅ Loaded {len(snapshots)} engagement snapshots into {table_id}")
+
+
+def load_media_records(
+    client: bigquery.Client,
+    project: str,
+    dataset: str,
+    table: str,
+    records: list[dict[str, str | int | None]],
+):
+    """Append the run's stored-media rows with a single load job."""
+    if not records:
+        return
+    table_id = f"{project}.{dataset}.{table}"
+    job_config = bigquery.LoadJobConfig(
+        schema=MEDIA_SCHEMA,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+    )
+    client.load_table_from_json(records, table_id, job_config=job_config).result()
+    print(f"✅ Loaded {len(records)} media records into {table_id}")
+
+
+def load_run_stats(
+    client: bigquery.Client,
+    project: str,
+    dataset: str,
+    table: str,
+    rows: list[dict[str, Any]],
+):
+    """Append a run's per-group stats with a single load job."""
+    if not rows:
+        return
+    table_id = f"{project}.{dataset}.{table}"
+    job_config = bigquery.LoadJobConfig(
+        schema=RUN_STATS_SCHEMA,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+    )
+    client.load_table_from_json(rows, table_id, job_config=job_config).result()
+    print(f"✅ Loaded stats for {len(rows)} groups into {table_id}")
+
+
+class BigQuerySink:
+    """Storage backend writing to BigQuery tables.
+
+    The pipeline only talks to its sink through these methods, so an offline
+    backend (see ``local_store.SQLiteSink``) can stand in for BigQuery.
+    All methods are blocking and are called through ``asyncio.to_thread``.
+    """
+
+    def __init__(
+        self,
+        client: bigquery.Client,
+        project: str,
+        dataset: str,
+        table: str = "telegram_messages",
+        metadata_table: str = "telegram_last_ingestion",
+        groups_table: str = "groups",
+        engagement_table: str = "telegram_engagement",
+        media_table: str = "telegram_media",
+        changes_table: str = "telegram_message_changes",
+        run_stats_table: str = "telegram_run_stats",
+    ):
+        self.client = client
+        self.project = project
+        self.dataset = dataset
+        self.table = table
+        self.metadata_table = metadata_table
+        self.groups_table = groups_table
+        self.engagement_table = engagement_table
+        self.media_table = media_table
+        self.changes_table = changes_table
+        self.run_stats_table = run_stats_table
+        self._run_plan: list[dict[str, str | None]] | None = None
+
+    def __repr__(self) -> str:
+        return f"BigQuerySink({self.project}.{self.dataset})"
+
+    def ensure_tables(self):
+        ensure_bq_table(
+            self.client, self.project, self.dataset, self.table, MESSAGES_SCHEMA
+        )
+        ensure_metadata_table(
+            self.client, self.project, self.dataset, self.metadata_table
+        )
+        ensure_bq_table(
+            self.client, self.project, self.dataset, self.changes_table, CHANGES_SCHEMA
+        )
+
+    def get_entities_data(self) -> list[dict[str, str | None]]:
+        """Groups to scrape with their cursors, queried once per sink (i.e. per run)."""
+        if self._run_plan is None:
+            self._run_plan = get_entities_data_from_bq(
+                self.project,
+                self.dataset,
+                self.groups_table,
+                self.client,
+                self.metadata_table,
+            )
+        return self._run_plan
+
+    def handle_new_messages(self, messages: list[MessageRow], entity_id: str) -> int:
+        return handle_new_messages(
+            messages, entity_id, self.client, self.project, self.dataset, self.table
+        )
+
+    def update_metadata(self, group_id: str, messages: list[MessageRow]):
+        update_metadata(
+            self.client,
+            self.project,
+            self.dataset,
+            self.metadata_table,
+            group_id,
+            messages,
+        )
+
+    def update_sync_state(self, group_id: str, pts: int):
+        update_sync_state(
+            self.client,
+            self.project,
+            self.dataset,
+            self.metadata_table,
+            group_id,
+            pts,
+        )
+
+    def record_message_changes(self, changes: list[dict[str, str | int | list[str] | None]]):
+        record_message_changes(
+            self.client, self.project, self.dataset, self.changes_table, changes
+        )
+
+    def get_recent_message_ids(self, days: int) -> dict[str, list[int]]:
+        return get_recent_message_ids(
+            self.client, self.project, self.dataset, self.table, days
+        )
+
+    def load_engagement_snapshots(self, snapshots: list[dict[str, str | int | None]]):
+        ensure_bq_table(
+            self.client,
+            self.project,
+            self.dataset,
+            self.engagement_table,
+            ENGAGEMENT_SCHEMA,
+        )
+        load_engagement_snapshots(
+            self.client, self.project, self.dataset, self.engagement_table, snapshots
+        )
+
+    def load_media_records(self, records: list[dict[str, str | int | None]]):
+        ensure_bq_table(
+            self.client, self.project, self.dataset, self.media_table, MEDIA_SCHEMA
+        )
+        load_media_records(
+            self.client, self.project, self.dataset, self.media_table, records
+        )
+
+    def load_run_stats(self, rows: list[dict[str, Any]]):
+        ensure_bq_table(
+            self.client,
+            self.project,
+            self.dataset,
+            self.run_stats_table,
+            RUN_STATS_SCHEMA,
+        )
+        load_run_stats(
+            self.client, self.project, self.dataset, self.run_stats_table, rows
+        )
+
+
 async def _ingest_telegram_to_bq_async(
     tg_entities_data: list[dict[str, str | None]],
-    bq_project: str,
-    bq_dataset: str,
-    bq_table: str,
-    bq_metadata_table: str,
-    telegram_config: dict[str, str],
     from_date: str | None,
     to_date: str,
-    bg_client: bigquery.Client,
+    sink: BigQuerySink,
+    client: TelegramClient,
+    use_takeout: bool = False,
+    normalization_pool: NormalizationPool | None = None,
+    near_dup_index: NearDupIndex | None = None,
+    default_from_date: str | None = None,
+    media_downloader: MediaDownloader | None = None,
+    sync_mode: str = "history",
 ) -> int:
-    """Async implementation that uses a single Telegram client connection."""
-    api_id = int(telegram_config["TELEGRAM_API_ID"])
-    api_hash = telegram_config["TELEGRAM_API_HASH"]
+    """Async implementation that uses a single, already connected Telegram client.
+
+    Sink calls are blocking, so they run in a worker thread to keep the
+    event loop (possibly the API server's) responsive while Telegram pages load.
+    Media downloads run beside the ingest loop and are awaited at the end, then
+    the per-group run stats are written in one go.
+    """
+    run_stats = RunStats("ingest")
+    async with AsyncExitStack() as stack:
+        history_client = await stack.enter_async_context(
+            history_export_client(client, use_takeout)
+        )
+        if media_downloader is not None:
+            await stack.enter_async_context(media_downloader.run(history_client))
+        total_inserted = await _ingest_entities_async(
+            tg_entities_data,
+            from_date,
+            to_date,
+            sink,
+            history_client,
+            normalization_pool,
+            near_dup_index,
+            default_from_date,
+            media_downloader,
+            sync_mode,
+            run_stats,
+        )
+    if media_downloader is not None:
+        async with track_await("sink.load_media_records"):
+            await asyncio.to_thread(sink.load_media_records, media_downloader.records)
+    await _write_run_stats_async(run_stats, sink)
+    return total_inserted
 
-    client = TelegramClient('fetch_session', api_id, api_hash)
-    total_inserted = 0
 
-    async with client:
-        for entity in tg_entities_data:
-            group_id = entity['id']  # For storing in BQ
-            entity_link = entity.get('link', entity['id'])  # For accessing Telegram
+async def _write_run_stats_async(run_stats: RunStats, sink: BigQuerySink):
+    """Write a run's per-group stats; the run's data is already stored, so never fail it."""
+    print(run_stats.summary())
+    try:
+        async with track_await("sink.load_run_stats"):
+            await asyncio.to_thread(sink.load_run_stats, run_stats.rows())
+    except Exception as e:
+        print(f"⚠ Could not write run stats: {e}")
 
-            print(f"\n\nProcessing entity: {entity_link} (ID: {group_id})")
 
-            try:
-                print(
-                    f"Fetching messages for {entity_link} from {from_date or entity['last_fetch_time'] or 'beginning'} to {to_date}"
+def resolve_fetch_start(
+    entity: dict[str, str | int | None],
+    from_date: str | None,
+    default_from_date: str | None = None,
+) -> tuple[datetime | None, int]:
+    """Work out where to resume a group: ``(offset_date, min_id)`` for iter_messages.
+
+    Groups with a cursor resume right after their last stored message id (or its
+    timestamp for cursors written before ids were tracked), unless an explicit
+    ``from_date`` is later than the cursor. Groups without a cursor start at
+    ``from_date``, else at ``default_from_date``.
+    """
+    last_fetch_time = entity.get('last_fetch_time')
+    last_message_id = entity.get('last_message_id')
+    if last_fetch_time or last_message_id:
+        if from_date and (
+            not last_fetch_time
+            or datetime.fromisoformat(from_date) > datetime.fromisoformat(last_fetch_time)
+        ):
+            return datetime.fromisoformat(from_date), 0
+        if last_message_id:
+            return None, int(last_message_id)
+        return datetime.fromisoformat(last_fetch_time), 0
+
+    start = from_date or default_from_date
+    return (datetime.fromisoformat(start) if start else None), 0
+
+
+# Windows ending closer to now than this are cut by date alone: the tail past
+# to_date is at most a page of new messages, not worth a request per group.
+WINDOW_EDGE_MIN_AGE = timedelta(hours=1)
+
+
+async def message_id_before(
+    client: TelegramClient, entity_link: str, date: datetime
+) -> int:
+    """Id of the newest message sent before ``date``, 0 when there is none."""
+    async with track_await("telegram.get_messages"):
+        messages = await client.get_messages(entity_link, limit=1, offset_date=date)
+    return messages[0].id if messages else 0
+
+
+async def resolve_window_ids(
+    client: TelegramClient,
+    entity_link: str,
+    from_date: datetime | None,
+    to_date: datetime | None,
+) -> tuple[int, int]:
+    """Resolve a date window to ``(min_id, max_id)``, exclusive bounds for iter_messages.
+
+    One ``get_messages`` call per given edge; ``max_id`` is 0 (unbounded) without
+    ``to_date``. Telegram dates have second precision, so messages sent exactly at
+    ``to_date`` stay in the window.
+    """
+    min_id = await message_id_before(client, entity_link, from_date) if from_date else 0
+    max_id = 0
+    if to_date:
+        max_id = await message_id_before(client, entity_link, to_date + timedelta(seconds=1)) + 1
+    return min_id, max_id
+
+
+async def _iter_history(
+    client: TelegramClient,
+    entity_link: str,
+    offset_date: datetime | None,
+    to_date: str | None,
+    min_id: int = 0,
+    max_id: int = 0,
+) -> AsyncIterator[Any]:
+    """Yield a group's messages oldest first, after ``offset_date``/``min_id``, up to ``to_date``.
+
+    With ``max_id`` Telethon stops paging at that id. Without it, a ``to_date`` in
+    the past older than ``WINDOW_EDGE_MIN_AGE`` is resolved to one, so re-reading
+    an old window does not page through everything sent since. In both cases the
+    first message past ``to_date`` ends the iteration.
+    """
+    to_date_dt = datetime.fromisoformat(to_date) if to_date else None
+    if (
+        not max_id
+        and to_date_dt
+        and to_date_dt < datetime.now(timezone.utc) - WINDOW_EDGE_MIN_AGE
+    ):
+        _, max_id = await resolve_window_ids(client, entity_link, None, to_date_dt)
+        if max_id <= min_id + 1:
+            return
+
+    async for message in client.iter_messages(
+        entity=entity_link,
+        offset_date=offset_date,
+        min_id=min_id,
+        max_id=max_id,
+        reverse=True,
+    ):
+        if to_date_dt and message.date > to_date_dt:
+            break
+        yield message
+
+
+SYNC_MODES = ("history", "difference")
+
+# Messages per getChannelDifference page; Telegram caps user accounts at 100
+DIFFERENCE_PAGE_LIMIT = 100
+
+
+async def get_channel_pts(client: TelegramClient, entity_link: str) -> int | None:
+    """Current update state (pts) of a supergroup/channel, None for basic groups."""
+    input_entity = await client.get_input_entity(entity_link)
+    if not isinstance(input_entity, InputPeerChannel):
+        return None
+    full = await client(GetFullChannelRequest(input_entity))
+    return full.full_chat.pts
+
+
+class ChannelDifference:
+    """What changed in a channel since a pts: new and edited messages, deleted ids.
+
+    ``senders`` maps peer ids to the users and chats the responses came with.
+    """
+
+    __slots__ = (
+        "start_pts",
+        "pts",
+        "new_messages",
+        "edited_messages",
+        "deleted_ids",
+        "senders",
+        "too_long",
+    )
+
+    def __init__(self, pts: int, too_long: bool = False):
+        self.start_pts = pts
+        self.pts = pts
+        self.new_messages: list[Message] = []
+        self.edited_messages: list[Message] = []
+        self.deleted_ids: list[int] = []
+        self.senders: dict[int, Any] = {}
+        self.too_long = too_long
+
+
+async def fetch_channel_difference(
+    client: TelegramClient, entity_link: str, pts: int
+) -> ChannelDifference:
+    """Page through updates.getChannelDifference from ``pts`` until it is final.
+
+    A quiet channel costs one request. When Telegram answers that the gap is too
+    long, ``too_long`` is set and ``pts`` is the channel's current state: the
+    caller falls back to a history fetch and resumes difference sync from there.
+    """
+    input_peer = await client.get_input_entity(entity_link)
+    channel = utils.get_input_channel(input_peer)
+    difference = ChannelDifference(pts)
+    while True:
+        response = await client(
+            GetChannelDifferenceRequest(
+                channel=channel,
+                filter=ChannelMessagesFilterEmpty(),
+                pts=difference.pts,
+                limit=DIFFERENCE_PAGE_LIMIT,
+                force=True,
+            )
+        )
+        if isinstance(response, ChannelDifferenceTooLong):
+            difference.too_long = True
+            difference.pts = getattr(response.dialog, "pts", None) or await get_channel_pts(
+                client, entity_link
+            )
+            return difference
+        difference.pts = response.pts
+        if isinstance(response, ChannelDifferenceEmpty):
+            return difference
+
+        # Raw responses carry their users/chats separately, and their messages have
+        # no message.sender; normalization looks senders up by sender_id instead
+        for entity in (*response.users, *response.chats):
+            difference.senders[utils.get_peer_id(entity)] = entity
+        for message in response.new_messages:
+            if isinstance(message, Message):
+                difference.new_messages.append(message)
+        for update in response.other_updates:
+            if isinstance(update, UpdateEditChannelMessage) and isinstance(update.message, Message):
+                difference.edited_messages.append(update.message)
+            elif isinstance(update, UpdateDeleteChannelMessages):
+                difference.deleted_ids.extend(update.messages)
+        if response.final:
+            return difference
+
+
+def message_changes(
+    difference: ChannelDifference, group_id: str
+) -> list[dict[str, str | int | list[str] | None]]:
+    """Edit rows and delete tombstones for the changes table."""
+    recorded_at = datetime.now(timezone.utc).isoformat()
+    changes = [
+        {
+            "message_id": str(message.id),
+            "group_id": group_id,
+            "change_type": "edit",
+            "message_text": message.message,
+            "links": extract_urls(message.message),
+            "edit_date": message.edit_date.isoformat() if message.edit_date else None,
+            "pts": difference.pts,
+            "recorded_at": recorded_at,
+        }
+        for message in difference.edited_messages
+    ]
+    changes.extend(
+        {
+            "message_id": str(message_id),
+            "group_id": group_id,
+            "change_type": "delete",
+            "message_text": None,
+            "links": [],
+            "edit_date": None,
+            "pts": difference.pts,
+            "recorded_at": recorded_at,
+        }
+        for message_id in difference.deleted_ids
+    )
+    return changes
+
+
+async def _store_messages_async(
+    messages: list[MessageRow],
+    group_id: str,
+    entity_link: str,
+    sink: BigQuerySink,
+    near_dup_index: NearDupIndex | None = None,
+    media_downloader: MediaDownloader | None = None,
+) -> int:
+    """Annotate and write fetched messages, then advance the cursor."""
+    if media_downloader is not None:
+        media_downloader.annotate(messages)
+
+    if near_dup_index is not None:
+        async with track_await("near_dup.annotate"):
+            near_dups = await asyncio.to_thread(near_dup_index.annotate, messages)
+        print(f"Found {near_dups} near-duplicate reposts in {entity_link}")
+
+    async with track_await("sink.handle_new_messages"):
+        inserted = await asyncio.to_thread(sink.handle_new_messages, messages, group_id)
+    group_stats = current_group_stats()
+    if group_stats is not None:
+        group_stats.record_messages(len(messages), inserted)
+
+    async with track_await("sink.update_metadata"):
+        await asyncio.to_thread(sink.update_metadata, group_id, messages)
+    return inserted
+
+
+async def _apply_channel_difference_async(
+    difference: ChannelDifference,
+    group_id: str,
+    entity_link: str,
+    sink: BigQuerySink,
+    near_dup_index: NearDupIndex | None = None,
+    media_downloader: MediaDownloader | None = None,
+) -> int:
+    """Write a difference's new messages and changes, then store its pts."""
+    # Quiet channels cost only the difference request, no write
+    if difference.pts == difference.start_pts:
+        print(f"No changes in {entity_link}")
+        return 0
+    print(
+        f"Difference for {entity_link}: {len(difference.new_messages)} new, "
+        f"{len(difference.edited_messages)} edited, {len(difference.deleted_ids)} deleted"
+    )
+    inserted = 0
+    if difference.new_messages:
+        if media_downloader is not None:
+            for message in difference.new_messages:
+                media_downloader.enqueue(message)
+        messages = [
+            normalize_message(message, group_id, difference.senders.get(message.sender_id))
+            for message in difference.new_messages
+        ]
+        inserted = await _store_messages_async(
+            messages, group_id, entity_link, sink, near_dup_index, media_downloader
+        )
+
+    changes = message_changes(difference, group_id)
+    if changes:
+        async with track_await("sink.record_message_changes"):
+            await asyncio.to_thread(sink.record_message_changes, changes)
+
+    async with track_await("sink.update_sync_state"):
+        await asyncio.to_thread(sink.update_sync_state, group_id, difference.pts)
+    return inserted
+
+
+async def _ingest_entity_async(
+    entity: dict[str, str | int | None],
+    from_date: str | None,
+    to_date: str,
+    sink: BigQuerySink,
+    client: TelegramClient,
+    normalization_pool: NormalizationPool | None = None,
+    near_dup_index: NearDupIndex | None = None,
+    default_from_date: str | None = None,
+    media_downloader: MediaDownloader | None = None,
+    sync_mode: str = "history",
+) -> int:
+    """Fetch and store one group's new messages; returns the number inserted.
+
+    With ``sync_mode="difference"`` a supergroup/channel with a stored pts is
+    synced from the channel difference instead of history, which also picks up
+    edits and deletions. Groups without a pts, and gaps Telegram reports as too
+    long, go through history and record the pts to continue from next time. That
+    history fetch ignores ``to_date`` and reads up to the newest message: the pts
+    is taken after ``to_date``, so the next difference starts after anything sent
+    in between. The overlap with that difference is removed by the duplicate check.
+    """
+    group_id = entity['id']  # For storing in BQ
+    entity_link = entity.get('link', entity['id'])  # For accessing Telegram
+
+    # Check if eligible
+    async with track_await("telegram.get_entity"):
+        eligible = await is_eligible_for_scraping(client, entity_link)
+    if not eligible:
+        return 0
+
+    start_pts = None
+    if sync_mode == "difference":
+        if entity.get('pts'):
+            async with track_await("telegram.get_channel_difference"):
+                difference = await fetch_channel_difference(
+                    client, entity_link, int(entity['pts'])
+                )
+            if not difference.too_long:
+                return await _apply_channel_difference_async(
+                    difference, group_id, entity_link, sink, near_dup_index, media_downloader
                 )
+            print(f"Difference for {entity_link} is too long, falling back to history")
+            start_pts = difference.pts
+        else:
+            # Taken before the history fetch so updates made meanwhile are not lost
+            async with track_await("telegram.get_full_channel"):
+                start_pts = await get_channel_pts(client, entity_link)
+
+    history_to_date = to_date if start_pts is None else None
+    offset_date, min_id = resolve_fetch_start(entity, from_date, default_from_date)
+    print(
+        f"Fetching messages for {entity_link} from "
+        f"{f'message {min_id}' if min_id else offset_date or 'beginning'} "
+        f"to {history_to_date or 'newest'}"
+    )
 
-                # Check if eligible
-                if not await is_eligible_for_scraping(client, entity_link):
-                    continue
-
-                # Determine offset_date
-                offset_date = None
-                if from_date:
-                    if entity['last_fetch_time']:
-                        last_ts_dt = datetime.fromisoformat(entity['last_fetch_time'])
-                        from_date_dt = datetime.fromisoformat(from_date)
-                        offset_date = last_ts_dt if last_ts_dt > from_date_dt else from_date_dt
-                    else:
-                        offset_date = datetime.fromisoformat(from_date)
-                elif entity['last_fetch_time']:
-                    offset_date = datetime.fromisoformat(entity['last_fetch_time'])
-
-                # Fetch messages
-                messages = []
-                async for message in client.iter_messages(
-                    entity=entity_link, offset_date=offset_date, reverse=True
-                ):
-                    if to_date and message.date > datetime.fromisoformat(to_date):
-                        continue
-                    messages.append(normalize_message(message, group_id))  # Store group_id in BQ
+    # Fetch messages, storing group_id in BQ
+    history = timed_iter(
+        "telegram.iter_messages",
+        _iter_history(client, entity_link, offset_date, history_to_date, min_id),
+    )
+    if media_downloader is not None:
+        history = media_downloader.tap(history)
+    messages = await collect_messages(history, group_id, normalization_pool)
+
+    print(f"Fetched {len(messages)} messages from {entity_link}")
+    inserted = 0
+    if messages:
+        inserted = await _store_messages_async(
+            messages, group_id, entity_link, sink, near_dup_index, media_downloader
+        )
 
-                print(f"Fetched {len(messages)} messages from {entity_link}")
+    if start_pts is not None:
+        async with track_await("sink.update_sync_state"):
+            await asyncio.to_thread(sink.update_sync_state, group_id, start_pts)
+    return inserted
 
-                if messages:
-                    inserted = handle_new_messages(
-                        messages, group_id, bg_client, bq_project, bq_dataset, bq_table
-                    )
-                    total_inserted += inserted
-
-                    update_metadata(
-                        bg_client,
-                        bq_project,
-                        bq_dataset,
-                        bq_metadata_table,
-                        group_id,
-                        messages,
+
+async def _ingest_entities_async(
+    tg_entities_data: list[dict[str, str | None]],
+    from_date: str | None,
+    to_date: str,
+    sink: BigQuerySink,
+    client: TelegramClient,
+    normalization_pool: NormalizationPool | None = None,
+    near_dup_index: NearDupIndex | None = None,
+    default_from_date: str | None = None,
+    media_downloader: MediaDownloader | None = None,
+    sync_mode: str = "history",
+    run_stats: RunStats | None = None,
+) -> int:
+    """Ingest groups one by one, reporting progress to the enclosing job if any.
+
+    Inside an API job each group is claimed first, so two concurrent jobs never
+    fetch and write the same group at the same time. Each group's costs are
+    collected in ``run_stats``.
+    """
+    if run_stats is None:
+        run_stats = RunStats("ingest")
+    total_inserted = 0
+    job = current_job()
+    if job is not None:
+        job.groups_total = len(tg_entities_data)
+
+    for entity in tg_entities_data:
+        group_id = entity['id']
+        entity_link = entity.get('link', entity['id'])
+
+        print(f"\n\nProcessing entity: {entity_link} (ID: {group_id})")
+
+        inserted = 0
+        with run_stats.group(group_id) as group_stats:
+            try:
+                async with claim_group(group_id):
+                    inserted = await _ingest_entity_async(
+                        entity,
+                        from_date,
+                        to_date,
+                        sink,
+                        client,
+                        normalization_pool,
+                        near_dup_index,
+                        default_from_date,
+                        media_downloader,
+                        sync_mode,
                     )
+                total_inserted += inserted
             except FloodWaitError as e:
                 print(f"Flood wait error for {entity_link}: waiting {e.seconds} seconds...")
+                group_stats.error = str(e)
+                record_flood_wait(e.seconds)
                 await asyncio.sleep(e.seconds)
             except Exception as e:
                 print(f"Error processing entity {entity_link}: {e}")
+                group_stats.error = str(e)
+
+        if job is not None:
+            job.group_done(group_id, inserted)
 
-        print(f"\nTotal messages inserted: {total_inserted}")
+    print(f"\nTotal messages inserted: {total_inserted}")
 
     return total_inserted
 
 
-def ingest_telegram_to_bq(
+async def _reingest_entity_async(
+    entity: dict[str, str | int | None],
+    min_id: int,
+    max_id: int,
+    sink: BigQuerySink,
+    client: TelegramClient,
+    normalization_pool: NormalizationPool | None = None,
+) -> int:
+    """Re-read one group's resolved id span and store messages that are missing.
+
+    The ingestion cursor is left alone: moving it to the window's end would make
+    the next regular run skip everything between the old cursor and the window.
+    """
+    group_id = entity['id']
+    entity_link = entity.get('link', entity['id'])
+
+    messages = await collect_messages(
+        timed_iter(
+            "telegram.iter_messages",
+            _iter_history(client, entity_link, None, None, min_id, max_id),
+        ),
+        group_id,
+        normalization_pool,
+    )
+    print(f"Fetched {len(messages)} messages from {entity_link} (ids {min_id + 1}-{max_id - 1})")
+    if not messages:
+        return 0
+    async with track_await("sink.handle_new_messages"):
+        inserted = await asyncio.to_thread(sink.handle_new_messages, messages, group_id)
+    group_stats = current_group_stats()
+    if group_stats is not None:
+        group_stats.record_messages(len(messages), inserted)
+    return inserted
+
+
+async def _reingest_window_async(
+    tg_entities_data: list[dict[str, str | int | None]],
+    from_date: datetime,
+    to_date: datetime,
+    sink: BigQuerySink,
+    client: TelegramClient,
+    concurrency: int = 4,
+    normalization_pool: NormalizationPool | None = None,
+    run_stats: RunStats | None = None,
+) -> int:
+    """Re-ingest ``[from_date, to_date]`` for many groups, ``concurrency`` at a time.
+
+    Every group's window is first resolved to a message id span (two cheap
+    requests per group, also run concurrently), empty spans are dropped, and the
+    rest are fetched largest first so one big group does not start last and
+    stretch the run. The groups' cursors are neither used nor updated: the window
+    is read as given.
+    """
+    if run_stats is None:
+        run_stats = RunStats("reingest")
+    job = current_job()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def resolve(entity):
+        entity_link = entity.get('link', entity['id'])
+        async with semaphore:
+            with run_stats.group(entity['id']) as group_stats:
+                try:
+                    if not await is_eligible_for_scraping(client, entity_link):
+                        return None
+                    return await resolve_window_ids(client, entity_link, from_date, to_date)
+                except Exception as e:
+                    print(f"Error resolving window for {entity_link}: {e}")
+                    group_stats.error = str(e)
+                    return None
+
+    spans = await asyncio.gather(*(resolve(entity) for entity in tg_entities_data))
+    planned = []
+    for entity, span in zip(tg_entities_data, spans):
+        if span is not None and span[1] > span[0] + 1:
+            planned.append((entity, *span))
+    planned.sort(key=lambda plan: plan[2] - plan[1], reverse=True)
+    print(
+        f"Re-ingesting {from_date.isoformat()} to {to_date.isoformat()}: "
+        f"{len(planned)} of {len(tg_entities_data)} groups have messages in the window"
+    )
+    if job is not None:
+        job.groups_total = len(planned)
+
+    async def reingest(entity, min_id, max_id):
+        group_id = entity['id']
+        entity_link = entity.get('link', entity['id'])
+        inserted = 0
+        async with semaphore:
+            with run_stats.group(group_id) as group_stats:
+                try:
+                    async with claim_group(group_id):
+                        inserted = await _reingest_entity_async(
+                            entity, min_id, max_id, sink, client, normalization_pool
+                        )
+                except FloodWaitError as e:
+                    print(f"Flood wait error for {entity_link}: waiting {e.seconds} seconds...")
+                    group_stats.error = str(e)
+                    record_flood_wait(e.seconds)
+                    await asyncio.sleep(e.seconds)
+                except Exception as e:
+                    print(f"Error re-ingesting {entity_link}: {e}")
+                    group_stats.error = str(e)
+        if job is not None:
+            job.group_done(group_id, inserted)
+        return inserted
+
+    total_inserted = sum(
+        await asyncio.gather(*(reingest(*plan) for plan in planned))
+    )
+    print(f"\nTotal messages inserted: {total_inserted}")
+    return total_inserted
+
+
+def _resolve_telegram_config(
+    telegram_config: dict[str, str | None] | None,
+) -> dict[str, str | None]:
+    """Fall back to Telegram credentials from the environment."""
+    if telegram_config is not None:
+        return telegram_config
+    load_dotenv()
+    api_id = os.getenv("TELEGRAM_API_ID")
+    api_hash = os.getenv("TELEGRAM_API_HASH")
+    if not api_id or not api_hash:
+        raise ValueError(
+            "TELEGRAM_API_ID and TELEGRAM_API_HASH must be set in environment variables"
+        )
+    return {
+        "TELEGRAM_API_ID": api_id,
+        "TELEGRAM_API_HASH": api_hash,
+    }
+
+
+async def ingest_telegram_to_bq_async(
     tg_entities_data: list[dict[str, str | None]],
-    bq_project: str,
+    bq_project: str | None,
     bq_dataset: str,
     bq_table: str = "telegram_messages",
     bq_metadata_table: str | None = "telegram_last_ingestion",
     telegram_config: dict[str, str | None] | None = None,
     from_date: str | None = None,
     to_date: str | None = None,
+    telegram_client: TelegramClient | None = None,
+    bq_client: bigquery.Client | None = None,
+    sink: BigQuerySink | None = None,
+    use_takeout: bool = False,
+    normalize_workers: int = 0,
+    normalize_batch_size: int = 1000,
+    normalization_pool: NormalizationPool | None = None,
+    near_dup_index: NearDupIndex | None = None,
+    default_from_date: str | None = None,
+    media_downloader: MediaDownloader | None = None,
+    sync_mode: str = "history",
 ) -> int:
     """
-    Ingests messages from Telegram groups into BigQuery with duplicate checks and metadata tracking.
+    Ingests messages on the running event loop, reusing long-lived clients when given.
+
+    ``telegram_client`` must be connected and bound to the current event loop; it is
+    left open afterwards so the caller can reuse it. Without one, a client is created
+    from ``telegram_config`` and disconnected at the end of the run. ``sink`` replaces
+    the BigQuery tables (and the ``bq_*`` arguments) with another storage backend.
+    ``use_takeout`` reads history through a takeout session, meant for backfills.
+    Normalization runs in ``normalization_pool``, which is left open for the caller,
+    or else with ``normalize_workers`` > 0 in a pool of that size created for the run.
+    ``near_dup_index`` fills ``content_hash``/``near_dup_of``; the caller persists it.
+    Groups resume from their metadata cursor; ``default_from_date`` is where groups
+    without one start (see ``resolve_fetch_start``). ``media_downloader`` stores the
+    messages' media in the background and fills ``media_url``. ``sync_mode`` is
+    one of ``SYNC_MODES`` (see ``_ingest_entity_async``).
     """
-    load_dotenv()
-    if telegram_config is None:
-        api_id = os.getenv("TELEGRAM_API_ID")
-        api_hash = os.getenv("TELEGRAM_API_HASH")
-        if not api_id or not api_hash:
-            raise ValueError(
-                "TELEGRAM_API_ID and TELEGRAM_API_HASH must be set in environment variables"
-            )
-        telegram_config = {
-            "TELEGRAM_API_ID": api_id,
-            "TELEGRAM_API_HASH": api_hash,
-        }
-
+    if sync_mode not in SYNC_MODES:
+        raise ValueError(f"Unknown sync mode: {sync_mode} (expected one of {SYNC_MODES})")
     if to_date is None:
         to_date = datetime.now(timezone.utc).isoformat()
 
-    bg_client = bigquery.Client(project=bq_project)
-    schema = [
-        bigquery.SchemaField("message_id", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("group_id", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("sender_id", "STRING"),
-        bigquery.SchemaField("sender_name", "STRING"),
-        bigquery.SchemaField("message_text", "STRING"),
-        bigquery.SchemaField("message_type", "STRING"),
-        bigquery.SchemaField("timestamp", "TIMESTAMP"),
-        bigquery.SchemaField("insert_date", "TIMESTAMP"),
-        bigquery.SchemaField("source", "STRING"),
-        bigquery.SchemaField("links", "STRING", mode="REPEATED"),
-        bigquery.SchemaField("telegram_url", "STRING"),
-        bigquery.SchemaField("views", "INTEGER"),
-        bigquery.SchemaField("replies", "INTEGER"),
-        bigquery.SchemaField("forwards", "INTEGER"),
-    ]
-    ensure_bq_table(bg_client, bq_project, bq_dataset, bq_table, schema)
-    ensure_metadata_table(bg_client, bq_project, bq_dataset, bq_metadata_table)
+    if sink is None:
+        if bq_client is None:
+            bq_client = bigquery.Client(project=bq_project)
+        sink = BigQuerySink(
+            bq_client, bq_project, bq_dataset, bq_table, bq_metadata_table
+        )
+    await asyncio.to_thread(sink.ensure_tables)
+
+    own_pool = normalization_pool is None and normalize_workers > 0
+    if own_pool:
+        normalization_pool = NormalizationPool(normalize_workers, normalize_batch_size)
+    if normalization_pool is not None:
+        print(f"Normalizing messages with {normalization_pool}")
+
+    try:
+        if telegram_client is not None:
+            if not telegram_client.is_connected():
+                await telegram_client.connect()
+            return await _ingest_telegram_to_bq_async(
+                tg_entities_data,
+                from_date,
+                to_date,
+                sink,
+                telegram_client,
+                use_takeout,
+                normalization_pool,
+                near_dup_index,
+                default_from_date,
+                media_downloader,
+                sync_mode,
+            )
+
+        telegram_config = _resolve_telegram_config(telegram_config)
+        async with initTelegramClient(telegram_config, "fetch_session") as client:
+            return await _ingest_telegram_to_bq_async(
+                tg_entities_data,
+                from_date,
+                to_date,
+                sink,
+                client,
+                use_takeout,
+                normalization_pool,
+                near_dup_index,
+                default_from_date,
+                media_downloader,
+                sync_mode,
+            )
+    finally:
+        if own_pool:
+            await normalization_pool.close()
+
+
+async def reingest_window_async(
+    tg_entities_data: list[dict[str, str | int | None]],
+    from_date: str,
+    to_date: str,
+    sink: BigQuerySink,
+    telegram_config: dict[str, str | None] | None = None,
+    telegram_client: TelegramClient | None = None,
+    concurrency: int = 4,
+    use_takeout: bool = False,
+    normalize_workers: int = 0,
+    normalize_batch_size: int = 1000,
+    normalization_pool: NormalizationPool | None = None,
+) -> int:
+    """
+    Re-read a bounded date window for many groups, e.g. to repair a gap.
+
+    Only the messages inside the window are downloaded (see ``resolve_window_ids``)
+    and only missing ones are stored. Client and normalization pool handling follow
+    ``ingest_telegram_to_bq_async``.
+    """
+    window_start = datetime.fromisoformat(from_date)
+    window_end = datetime.fromisoformat(to_date)
+    if window_end <= window_start:
+        raise ValueError(f"Empty window: {from_date} to {to_date}")
+    await asyncio.to_thread(sink.ensure_tables)
+
+    own_pool = normalization_pool is None and normalize_workers > 0
+    if own_pool:
+        normalization_pool = NormalizationPool(normalize_workers, normalize_batch_size)
+
+    async def run(client: TelegramClient) -> int:
+        run_stats = RunStats("reingest")
+        async with history_export_client(client, use_takeout) as history_client:
+            total_inserted = await _reingest_window_async(
+                tg_entities_data,
+                window_start,
+                window_end,
+                sink,
+                history_client,
+                concurrency,
+                normalization_pool,
+                run_stats,
+            )
+        await _write_run_stats_async(run_stats, sink)
+        return total_inserted
+
+    try:
+        if telegram_client is not None:
+            if not telegram_client.is_connected():
+                await telegram_client.connect()
+            return await run(telegram_client)
+
+        telegram_config = _resolve_telegram_config(telegram_config)
+        async with initTelegramClient(telegram_config, "fetch_session") as client:
+            return await run(client)
+    finally:
+        if own_pool:
+            await normalization_pool.close()
+
+
+async def _refresh_engagement_async(
+    tg_entities_data: list[dict[str, str | None]],
+    ids_by_group: dict[str, list[int]],
+    client: TelegramClient,
+) -> list[dict[str, str | int | None]]:
+    """Fetch current counters for known message ids in batches of up to 100.
+
+    Reports progress to the enclosing job if any, counting snapshots as the
+    job's inserted rows. Groups are not claimed: snapshots are appended and
+    never conflict with an ingest of the same group.
+    """
+    snapshots: list[dict[str, str | int | None]] = []
+    snapshot_time = datetime.now(timezone.utc).isoformat()
+    job = current_job()
+    if job is not None:
+        job.groups_total = len(tg_entities_data)
+
+    for entity in tg_entities_data:
+        group_id = entity['id']
+        entity_link = entity.get('link', entity['id'])
+        message_ids = ids_by_group.get(group_id)
+        if not message_ids:
+            if job is not None:
+                job.group_done(group_id)
+            continue
+
+        print(f"Refreshing engagement for {len(message_ids)} messages in {entity_link}")
+        if job is not None:
+            job.current_group = group_id
+        group_start = len(snapshots)
+        try:
+            for start in range(0, len(message_ids), ENGAGEMENT_BATCH_SIZE):
+                batch = message_ids[start:start + ENGAGEMENT_BATCH_SIZE]
+                async with track_await("telegram.get_messages"):
+                    messages = await retry_on_flood(
+                        client.get_messages, entity_link, ids=batch
+                    )
+                for message in messages:
+                    # Deleted or inaccessible messages come back as None
+                    if message is None:
+                        continue
+                    replies = getattr(message, "replies", None)
+                    snapshots.append(
+                        {
+                            "message_id": str(message.id),
+                            "group_id": group_id,
+                            "views": getattr(message, "views", None),
+                            "replies": replies.replies if replies else None,
+                            "forwards": getattr(message, "forwards", None),
+                            "snapshot_time": snapshot_time,
+                        }
+                    )
+        except Exception as e:
+            print(f"Error refreshing engagement for {entity_link}: {e}")
+
+        if job is not None:
+            job.group_done(group_id, len(snapshots) - group_start)
+
+    return snapshots
 
+
+async def refresh_engagement_async(
+    tg_entities_data: list[dict[str, str | None]],
+    bq_project: str | None,
+    bq_dataset: str,
+    bq_table: str = "telegram_messages",
+    bq_engagement_table: str = "telegram_engagement",
+    days: int = 7,
+    telegram_config: dict[str, str | None] | None = None,
+    telegram_client: TelegramClient | None = None,
+    bq_client: bigquery.Client | None = None,
+    sink: BigQuerySink | None = None,
+) -> int:
+    """
+    Re-read views/replies/forwards of the last ``days`` days of messages and append
+    them as snapshot rows to the engagement table.
+    """
+    if sink is None:
+        if bq_client is None:
+            bq_client = bigquery.Client(project=bq_project)
+        sink = BigQuerySink(
+            bq_client, bq_project, bq_dataset, bq_table,
+            engagement_table=bq_engagement_table,
+        )
+    ids_by_group = await asyncio.to_thread(sink.get_recent_message_ids, days)
+    print(
+        f"Found {sum(len(ids) for ids in ids_by_group.values())} messages from the last {days} days"
+    )
+
+    if telegram_client is not None:
+        if not telegram_client.is_connected():
+            await telegram_client.connect()
+        snapshots = await _refresh_engagement_async(
+            tg_entities_data, ids_by_group, telegram_client
+        )
+    else:
+        telegram_config = _resolve_telegram_config(telegram_config)
+        async with initTelegramClient(telegram_config, "fetch_session") as client:
+            snapshots = await _refresh_engagement_async(
+                tg_entities_data, ids_by_group, client
+            )
+
+    await asyncio.to_thread(sink.load_engagement_snapshots, snapshots)
+    return len(snapshots)
+
+
+def ingest_telegram_to_bq(
+    tg_entities_data: list[dict[str, str | None]],
+    bq_project: str,
+    bq_dataset: str,
+    bq_table: str = "telegram_messages",
+    bq_metadata_table: str | None = "telegram_last_ingestion",
+    telegram_config: dict[str, str | None] | None = None,
+    from_date: str | None = None,
+    to_date: str | None = None,
+) -> int:
+    """
+    Ingests messages from Telegram groups into BigQuery with duplicate checks and metadata tracking.
+    """
     # Use a single asyncio.run with one client connection for all entities
-    total_inserted = asyncio.run(
-        _ingest_telegram_to_bq_async(
+    return asyncio.run(
+        ingest_telegram_to_bq_async(
             tg_entities_data,
             bq_project,
             bq_dataset,
@@ -668,8 +2089,5 @@ def ingest_telegram_to_bq(
             telegram_config,
             from_date,
             to_date,
-            bg_client,
         )
     )
-
-    return total_inserted
@@ -43,6 +43,26 @@ resource "google_cloud_run_v2_service" "main" {
         value = "groups"
       }
 
+      env {
+        name  = "BQ_ENGAGEMENT_TABLE"
+        value = "telegram_engagement"
+      }
+
+      env {
+        name  = "BQ_MEDIA_TABLE"
+        value = "telegram_media"
+      }
+
+      env {
+        name  = "BQ_CHANGES_TABLE"
+        value = "telegram_message_changes"
+      }
+
+      env {
+        name  = "BQ_RUN_STATS_TABLE"
+        value = "telegram_run_stats"
+      }
+
       env {
         name = "TELEGRAM_API_ID"
         value_source {
@@ -16,3 +16,22 @@ resource "google_cloud_scheduler_job" "job" {
     retry_count = 1
   }
 }
+
+resource "google_cloud_scheduler_job" "engagement_refresh" {
+  name        = "${var.service_name}-engagement-refresh"
+  description = "Refreshes views/replies/forwards of recent messages via the ${var.service_name} Cloud Run service"
+  schedule    = "0 15 * * *" # Runs every day at 3:00 PM UTC, away from the ingestion run
+
+  http_target {
+    uri         = "${google_cloud_run_v2_service.main.uri}/refresh-engagement"
+    http_method = "POST"
+
+    oidc_token {
+      service_account_email = "telegram-scraper-sa@${var.project_id}.iam.gserviceaccount.com"
+    }
+  }
+
+  retry_config {
+    retry_count = 1
+  }
+}